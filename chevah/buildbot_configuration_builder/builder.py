@@ -1,34 +1,86 @@
 #
 # Create buildbot configuration based on a (almost) plain dict.
 #
+import hashlib
+import json
+import os
 import random
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+import types
+import weakref
+from collections import OrderedDict
+from contextlib import closing
+from distutils.version import LooseVersion
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from fnmatch import fnmatch
+from functools import partial
+from StringIO import StringIO
 
 from buildbot.buildslave import BuildSlave
 from buildbot.config import BuilderConfig
 from buildbot.changes.gitpoller import GitPoller
 from buildbot.changes.filter import ChangeFilter
 from buildbot.interfaces import IEmailLookup
+from buildbot.locks import SlaveLock
 from buildbot.process.buildstep import BuildStep
 from buildbot.process.factory import BuildFactory
-from buildbot.process.properties import Property, Interpolate
+from buildbot.process.logobserver import LogLineObserver
+from buildbot.process.buildrequest import BuildRequest
+from buildbot.process.properties import Properties, Property, Interpolate
+from buildbot.process.remotecommand import RemoteShellCommand
 from buildbot.process.buildrequestdistributor import BasicBuildChooser
 from buildbot.schedulers.basic import SingleBranchScheduler
 from buildbot.schedulers.triggerable import Triggerable
 from buildbot.schedulers.trysched import Try_Userpass
 from buildbot.status import html
+from buildbot.status.base import StatusReceiverMultiService
 from buildbot.status.github import GitHubStatus
-from buildbot.status.results import FAILURE, SKIPPED, SUCCESS
+from buildbot.status.results import EXCEPTION, FAILURE, SKIPPED, SUCCESS
 from buildbot.status.web import authz
 from buildbot.status.web.auth import HTPasswdAuth
+from buildbot.status.web.hooks.github import GitHubEventHandler
 from buildbot.status.mail import MailNotifier as BuildbotMailNotifier
 from buildbot.steps.master import MasterShellCommand
-from buildbot.steps.shell import ShellCommand
+from buildbot.steps.shell import SetPropertyFromCommand, ShellCommand
 from buildbot.steps.source.git import Git
-from buildbot.steps.transfer import DirectoryUpload
+from buildbot.steps.transfer import (
+    DirectoryUpload,
+    FileUpload,
+    _FileWriter,
+    _TransferBuildStep,
+    makeStatusRemoteCommand,
+    )
 from buildbot.steps.trigger import Trigger
-from twisted.internet import defer
+from twisted.internet import defer, protocol, reactor, threads
+from twisted.mail.smtp import (
+    DNSNAME,
+    SUCCESS as SMTP_SUCCESS,
+    ESMTPSender,
+    SMTPClient,
+    SMTPClientError,
+    )
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody,
+    )
+from twisted.web.http_headers import Headers
 from zope.interface import implements
 
+try:
+    from PIL import Image
+except ImportError:
+    # Thumbnails for attached images are optional.
+    Image = None
+
 ALL = object()
 DEFAULT = object()
 DIRECTORY_UPLOAD = 'directory_upload'
@@ -42,14 +94,255 @@ SEQUENTIAL_GROUP = 'sequential_group'
 MASTER_COMMAND = 'master_command'
 SLAVE_COMMAND = 'slave_command'
 SOURCE_COMMAND = 'source_command'
+CACHE_COMMAND = 'cache_command'
+CONCURRENT_COMMAND = 'concurrent_command'
 
 ATTACH_PNG = 'attach_png'
 
 TRY = object()
 
 POLL_INTERVAL = 60
+# Maximum seconds between polls when there are no new changes.
+MAX_POLL_INTERVAL = 300
 STABLE_TIMER = 300
 
+# Number of finished builds used to compute the recent build duration
+# of a builder on each slave.
+SLAVE_HISTORY = 10
+
+# Slave affinity modes.
+AFFINITY_BUILDER = 'builder'
+AFFINITY_PROJECT = 'project'
+# Seconds after which the previous slave of a workspace is no longer
+# preferred.
+AFFINITY_TIMEOUT = 3600
+
+# Seconds for which a successful build result is reused.
+RESULT_CACHE_TTL = 86400
+
+# Seconds to wait for more emails before sending them in a single SMTP
+# session.
+MAIL_BATCH_DELAY = 10
+# Number of times to retry sending an email and the seconds to wait before
+# the first retry, which is doubled for each retry.
+MAIL_RETRIES = 5
+MAIL_RETRY_DELAY = 30
+# Seconds for which an email address is cached by DelegatedLookup.
+LOOKUP_CACHE_TTL = 3600
+# Attached files are served by the web status from its public_html folder.
+ATTACHMENTS_PATH = 'public_html/attachments'
+ATTACHMENTS_URL = 'attachments'
+# Larger images are not attached.
+ATTACH_PNG_MAX_SIZE = 5 * 1024 * 1024
+# Content-addressed store for files uploaded by incremental directory
+# uploads, relative to master base directory.
+UPLOAD_STORE_PATH = 'upload_store'
+# Files from the store which were not used by any destination for this
+# many seconds are removed. The store is checked at most this often.
+UPLOAD_STORE_PRUNE_AGE = 24 * 3600
+# Archive with the changed files, created in the build folder on the slave.
+UPLOAD_ARCHIVE = '.buildbot-upload.tar.gz'
+# Run on the slave to list "SHA1 SIZE PATH" for all files from a folder.
+UPLOAD_HASH_SCRIPT = """
+import hashlib, os, sys
+root = sys.argv[1]
+if not os.path.isdir(root):
+    sys.exit('Not a folder: %s' % (root,))
+for base, dirs, files in os.walk(root):
+    for name in files:
+        path = os.path.join(base, name)
+        digest = hashlib.sha1()
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(65536), b''):
+                digest.update(chunk)
+        relative = os.path.relpath(path, root).replace(os.sep, '/')
+        sys.stdout.write('%s %d %s\\n' % (
+            digest.hexdigest(), os.path.getsize(path), relative))
+"""
+# Run on the slave to archive the "SHA1 PATH" files read from stdin, using
+# the SHA1 as name.
+UPLOAD_PACK_SCRIPT = """
+import os, sys, tarfile
+root, archive = sys.argv[1:3]
+with tarfile.open(archive, 'w:gz') as tar:
+    for line in sys.stdin:
+        digest, path = line.rstrip('\\n').split(' ', 1)
+        tar.add(os.path.join(root, path), arcname=digest, recursive=False)
+"""
+# Folder shared by all builders of a slave, relative to the build folder,
+# with the caches of the CACHE_COMMAND steps.
+SHARED_CACHE_PATH = '../../shared_cache'
+# Least recently used caches are removed above this size.
+SHARED_CACHE_MAX_SIZE = 5 * 1024 * 1024 * 1024
+# Run on the slave to restore or save a cache.
+#   restore ROOT NAME PATH [KEY_FILE ...] - print "hit KEY" or "miss KEY"
+#   save ROOT NAME PATH KEY MAX_SIZE
+SHARED_CACHE_SCRIPT = """
+import hashlib, os, shutil, sys
+action, root, name, path = sys.argv[1:5]
+if action == 'restore':
+    digest = hashlib.sha1(
+        os.environ.get('TEST_ENVIRONMENT', '').encode('utf-8'))
+    for key_file in sys.argv[5:]:
+        with open(key_file, 'rb') as stream:
+            digest.update(stream.read())
+    key = digest.hexdigest()
+    entry = os.path.join(root, name, key)
+    if os.path.isdir(entry):
+        try:
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            shutil.copytree(entry, path, symlinks=True)
+            os.utime(entry, None)
+            print('hit %s' % (key,))
+            sys.exit(0)
+        except (IOError, OSError) as error:
+            print('Failed to restore: %s' % (error,))
+    print('miss %s' % (key,))
+    sys.exit(0)
+
+key, max_size = sys.argv[5], int(sys.argv[6])
+entry = os.path.join(root, name, key)
+if not os.path.isdir(os.path.dirname(entry)):
+    os.makedirs(os.path.dirname(entry))
+if not os.path.isdir(entry):
+    staging = '%s.%d' % (entry, os.getpid())
+    shutil.copytree(path, staging, symlinks=True)
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        # Saved in the meantime by another build.
+        shutil.rmtree(staging)
+
+entries = []
+for cache in os.listdir(root):
+    for other in os.listdir(os.path.join(root, cache)):
+        other = os.path.join(root, cache, other)
+        if '.' in os.path.basename(other):
+            continue
+        size = 0
+        for base, dirs, files in os.walk(other):
+            for member in files:
+                size += os.lstat(os.path.join(base, member)).st_size
+        entries.append((os.path.getmtime(other), size, other))
+total = sum([size for dummy, size, dummy in entries])
+for dummy, size, other in sorted(entries):
+    if total <= max_size:
+        break
+    if other == entry:
+        continue
+    print('Removing %s' % (other,))
+    shutil.rmtree(other, ignore_errors=True)
+    total -= size
+"""
+# Folder with the Git mirrors shared by all builders of a slave, relative to
+# the build folder.
+GIT_MIRRORS_PATH = '../../git_mirrors'
+# Run on the slave to create or update the mirror of a Git repository.
+GIT_MIRROR_SCRIPT = """
+import os, subprocess, sys
+repository, path = sys.argv[1:3]
+if os.path.isdir(path):
+    command = ['git', '--git-dir', path, 'fetch', '--prune', 'origin']
+else:
+    command = ['git', 'clone', '--mirror', repository, path]
+sys.exit(subprocess.call(command))
+"""
+# Run on the slave to execute the JSON list of {name, command, env} from
+# the second argument, with at most the first argument commands at the same
+# time. Output lines are prefixed with the command name and the result of
+# each command is printed at the end as "RESULT NAME EXIT_CODE DURATION".
+CONCURRENT_SCRIPT = """
+import json, os, subprocess, sys, threading, time
+max_parallel, commands = int(sys.argv[1]), json.loads(sys.argv[2])
+slots = threading.Semaphore(max_parallel)
+output = threading.Lock()
+stream = getattr(sys.stdout, 'buffer', sys.stdout)
+results = {}
+
+def native(value):
+    if str is bytes and not isinstance(value, bytes):
+        return value.encode('utf-8')
+    return value
+
+def write(name, line):
+    if not line.endswith(b'\\n'):
+        line += b'\\n'
+    with output:
+        stream.write(name.encode('utf-8') + b'| ' + line)
+        stream.flush()
+
+def run(command):
+    with slots:
+        start = time.time()
+        environment = os.environ.copy()
+        for key, value in command['env'].items():
+            environment[native(key)] = native(value)
+        arguments = command['command']
+        shell = not isinstance(arguments, list)
+        if shell:
+            arguments = native(arguments)
+        else:
+            arguments = [native(argument) for argument in arguments]
+        try:
+            process = subprocess.Popen(
+                arguments, shell=shell, env=environment,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as error:
+            write(command['name'], str(error).encode('utf-8'))
+            results[command['name']] = (-1, time.time() - start)
+            return
+        for line in iter(process.stdout.readline, b''):
+            write(command['name'], line)
+        results[command['name']] = (process.wait(), time.time() - start)
+
+threads = [
+    threading.Thread(target=run, args=(command,)) for command in commands]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+failed = False
+for command in commands:
+    code, duration = results[command['name']]
+    failed = failed or code != 0
+    sys.stdout.write('RESULT %s %s %.1f\\n' % (
+        command['name'], code, duration))
+sys.exit(1 if failed else 0)
+"""
+# Run on the slave to remove the archive once it was uploaded.
+UPLOAD_REMOVE_SCRIPT = """
+import os, sys
+if os.path.exists(sys.argv[1]):
+    os.remove(sys.argv[1])
+"""
+# Seconds to wait for more updates of the same GitHub status before
+# sending it.
+GITHUB_STATUS_DELAY = 5
+GITHUB_API_URL = 'https://api.github.com'
+
+# Environment variables set for all steps, based on build properties.
+# Interpolate objects are not changed by rendering so they are shared by
+# all step environments.
+PROPERTIES_ENVIRONMENT = {
+    'COMMIT': Interpolate('%(prop:got_revision)s'),
+    'BRANCH': Interpolate('%(prop:branch)s'),
+    'BUILD_NUMBER': Interpolate('%(prop:buildnumber)s'),
+    'BUILDER_NAME': Interpolate('%(prop:buildername)s'),
+    'BUILD_DIR': Interpolate('%(prop:workdir)s'),
+    'TEST_ARGUMENTS': Interpolate('%(prop:test)s'),
+
+    'CODECOV_TOKEN': Interpolate('%(prop:codecov_token)s'),
+
+    'GITHUB_PULL_ID': Interpolate('%(prop:github_pull_id)s'),
+    'TEST_AUTHOR': Interpolate('%(prop:author)s'),
+    }
+
+# Root configuration keys used when generating the builders of a project.
+PROJECT_ROOT_KEYS = [
+    'change_source', 'email', 'github', 'result_cache', 'try_scheduler']
+
 
 @defer.inlineCallbacks
 def popNextBuild(self):
@@ -96,10 +389,387 @@ def popNextBuild(self):
 
     defer.returnValue(nextBuild)
 
+
+def getRequestPriority(request):
+    """
+    Return the priority of a build request.
+
+    Requests with higher priority are started first.
+    """
+    priority = request.properties.getProperty('priority', None)
+    if priority is None:
+        priority = request.priority
+    try:
+        return int(priority or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def nextBuild(builder, requests):
+    """
+    Return the request with the highest priority, or the oldest request
+    when priorities are equal.
+    """
+    return min(requests, key=lambda request: (
+        -getRequestPriority(request), request.submittedAt))
+
+
+@defer.inlineCallbacks
+def popNextBatchBuild(self):
+    """
+    Called when a new build should be created, in batch mode.
+
+    On the first call, all pending requests and available slaves are
+    fetched once and matched in a single pass, in priority order.
+    Each call returns the next matched pair, calling `canStartBuild` only
+    for that pair.
+    """
+    if getattr(self, '_batch_matches', None) is None:
+        yield _matchBatch(self)
+
+    next_build = (None, None)
+
+    while self._batch_matches:
+        slave, breq = self._batch_matches.pop(0)
+        if self._getBrdictForBuildRequest(breq) is None:
+            # Request was merged into a previous build, so the slave is
+            # used for a request which was not matched.
+            breq = _popBatchWaiting(self, slave)
+            if breq is None:
+                continue
+
+        self.bldr.current_builder_request = breq
+        self.canStartBuildCalls += 1
+        can_start = yield self.canStartBuild(slave, breq)
+        if can_start:
+            self._removeBuildRequest(breq)
+            next_build = (slave, breq)
+            break
+
+    if not next_build[0] and self.canStartBuildCalls:
+        # Pass is done.
+        self.bldr.can_start_build_calls = self.canStartBuildCalls
+        log.msg('Batch pass for %s made %d canStartBuild calls.' % (
+            self.bldr.name, self.canStartBuildCalls))
+        self.canStartBuildCalls = 0
+
+    defer.returnValue(next_build)
+
+
+@defer.inlineCallbacks
+def _matchBatch(self):
+    """
+    Fetch all pending requests and available slaves and match them in a
+    single pass.
+
+    Requests without a slave are kept in `_batch_waiting`.
+    """
+    self.canStartBuildCalls = 0
+    self._batch_matches = []
+    self._batch_waiting = []
+
+    yield self._fetchUnclaimedBrdicts()
+    requests = yield self._getUnclaimedBuildRequests()
+    requests.sort(key=lambda request: (
+        -getRequestPriority(request), request.submittedAt))
+
+    can_start = yield defer.gatherResults([
+        defer.maybeDeferred(self.bldr.canStartWithSlavebuilder, slave)
+        for slave in self.slavepool
+        ])
+    preferred = []
+    rejected = []
+    for slave, usable in zip(self.slavepool, can_start):
+        if usable:
+            preferred.append(slave)
+        else:
+            # Keep them as a last resort, as done by BasicBuildChooser.
+            rejected.append(slave)
+
+    for breq in requests:
+        slave = None
+        if preferred or rejected:
+            slave = yield _chooseBatchSlave(self, breq, preferred, rejected)
+
+        if slave is None:
+            self._batch_waiting.append(breq)
+            continue
+
+        if slave in preferred:
+            preferred.remove(slave)
+        else:
+            rejected.remove(slave)
+        self._batch_matches.append((slave, breq))
+
+
+@defer.inlineCallbacks
+def _chooseBatchSlave(self, breq, preferred, rejected):
+    """
+    Return the slave to be matched with `breq`.
+
+    The slave from the `target-slave` property is used when available.
+    Otherwise, the slave is chosen using `nextSlave` from the `preferred`
+    slaves, and from the `rejected` slaves as a last resort.
+    """
+    target_name = breq.properties.getProperty('target-slave')
+    candidates = [
+        slave for slave in preferred + rejected
+        if target_name and slave.slave.slavename == target_name
+        ]
+    if not candidates:
+        candidates = preferred or rejected
+
+    self.bldr.current_builder_request = breq
+    try:
+        slave = yield self.nextSlave(self.bldr, candidates)
+    except Exception:
+        log.err(None, 'Failed to choose slave for %s' % (self.bldr.name,))
+        slave = None
+    if slave not in candidates:
+        slave = candidates[0]
+
+    defer.returnValue(slave)
+
+
+def _popBatchWaiting(self, slave):
+    """
+    Return the first pending request which was not matched and can use
+    `slave`, or None.
+    """
+    for breq in self._batch_waiting[:]:
+        if self._getBrdictForBuildRequest(breq) is None:
+            # Merged into a previous build.
+            self._batch_waiting.remove(breq)
+            continue
+
+        target_name = breq.properties.getProperty('target-slave')
+        if target_name and target_name != slave.slave.slavename:
+            continue
+
+        self._batch_waiting.remove(breq)
+        return breq
+
+    return None
+
+
 # Patch Buildbot
 BasicBuildChooser.popNextBuild = popNextBuild
 
 
+def fingerprint(value):
+    """
+    Return a hash for a configuration value, which is stable between
+    master restarts.
+    """
+    return hashlib.sha1(_getFingerprintData(value)).hexdigest()
+
+
+def _getFingerprintData(value, seen=()):
+    """
+    Return a stable text representation of a configuration value.
+
+    `seen` are the ids of the objects containing `value`, used to stop
+    on recursive values.
+    """
+    for name, sentinel in [
+            ('ALL', ALL),
+            ('DEFAULT', DEFAULT),
+            ('GITHUB_PULL_TITLE', GITHUB_PULL_TITLE),
+            ('INTERESTED_USERS', INTERESTED_USERS),
+            ('TRY', TRY),
+            ]:
+        if value is sentinel:
+            return name
+
+    if id(value) in seen:
+        return 'recursive:%s' % (type(value).__name__,)
+    nested = seen + (id(value),)
+
+    if isinstance(value, dict):
+        items = sorted([
+            '%s:%s' % (
+                _getFingerprintData(key, nested),
+                _getFingerprintData(item, nested),
+                )
+            for key, item in value.items()
+            ])
+        return '{%s}' % (','.join(items),)
+
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % (','.join([
+            _getFingerprintData(item, nested) for item in value]),)
+
+    if isinstance(value, types.FunctionType):
+        return _getFunctionData(value, nested)
+
+    if isinstance(value, types.MethodType):
+        return '%s.%s' % (
+            value.im_class.__name__,
+            _getFunctionData(value.im_func, nested),
+            )
+
+    if isinstance(value, partial):
+        return 'partial(%s)' % (_getFingerprintData(
+            [value.func, value.args, value.keywords or {}], nested),)
+
+    if isinstance(value, (types.ClassType, type)):
+        return '%s.%s' % (value.__module__, value.__name__)
+
+    if isinstance(value, types.ModuleType):
+        return 'module:%s' % (value.__name__,)
+
+    if type(value) is object:
+        # Other sentinels, like the ones used by Interpolate.
+        return 'object'
+
+    if hasattr(value, '__dict__'):
+        return '%s(%s)' % (
+            value.__class__.__name__,
+            _getFingerprintData(vars(value), nested),
+            )
+
+    return repr(value)
+
+
+def _getFunctionData(function, seen):
+    """
+    Return a stable text representation of a function.
+
+    It includes the code, constants, default arguments, closure values and
+    the referenced globals, so that a changed function, like a lambda with
+    the same name, has a different representation.
+    """
+    code = function.func_code
+    referenced = {}
+    for name in _getCodeNames(code):
+        if name in function.func_globals:
+            referenced[name] = function.func_globals[name]
+
+    closure = []
+    for cell in function.func_closure or ():
+        try:
+            closure.append(cell.cell_contents)
+        except ValueError:
+            # Cell not yet assigned.
+            closure.append(None)
+
+    return '%s.%s:%s' % (
+        function.__module__,
+        function.__name__,
+        _getFingerprintData([
+            _getCodeData(code),
+            function.func_defaults or (),
+            closure,
+            referenced,
+            ], seen),
+        )
+
+
+def _getCodeData(code):
+    """
+    Return the bytecode and constants of `code`, including nested code.
+    """
+    constants = []
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            constant = _getCodeData(constant)
+        else:
+            constant = repr(constant)
+        constants.append(constant)
+    return [
+        hashlib.sha1(code.co_code).hexdigest(), constants, code.co_names]
+
+
+def _getCodeNames(code):
+    """
+    Return the global and attribute names used by `code` and its nested
+    code.
+    """
+    result = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, types.CodeType):
+            result.update(_getCodeNames(constant))
+    return result
+
+
+def getPatchFiles(diff, level=1):
+    """
+    Return the set of files changed by a patch in unified `diff` format,
+    with `level` leading path components removed.
+    """
+    result = set()
+    for line in diff.splitlines():
+        if not line.startswith('+++ ') and not line.startswith('--- '):
+            continue
+        path = line[4:].split('\t', 1)[0].strip()
+        if not path or path == '/dev/null':
+            continue
+        result.add('/'.join(path.split('/')[level:]))
+    return result
+
+
+def getChangedFiles(build):
+    """
+    Return the set of files changed by the changes and patches of `build`,
+    or None when the changed files are not known.
+    """
+    result = set()
+    known = False
+
+    for change in build.allChanges():
+        if not change.files:
+            # Some changes, like merges, don't report their files.
+            return None
+        known = True
+        result.update(change.files)
+
+    for source_stamp in build.getAllSourceStamps():
+        if not source_stamp.patch:
+            continue
+        known = True
+        level, diff = source_stamp.patch[:2]
+        result.update(getPatchFiles(diff, level))
+
+    if not known:
+        return None
+    return result
+
+
+def matchPaths(files, paths=None, ignore_paths=None):
+    """
+    Return True if any of the `files` matches the glob `paths` and does
+    not match the glob `ignore_paths`.
+
+    When `files` are not known, it will always match.
+    """
+    if files is None:
+        return True
+
+    for path in files:
+        if paths and not [
+                pattern for pattern in paths if fnmatch(path, pattern)]:
+            continue
+        if ignore_paths and [
+                pattern for pattern in ignore_paths if fnmatch(path, pattern)]:
+            continue
+        return True
+
+    return False
+
+
+def extractCacheMiss(property_name, rc, stdout, stderr):
+    """
+    Return the properties set by a cache restore step.
+
+    On a cache miss `property_name` is set to the cache key, so that the
+    cache is saved at the end of the build.
+    """
+    for line in stdout.splitlines():
+        if line.startswith('miss '):
+            return {property_name: line.split(' ', 1)[1]}
+    return {}
+
+
 class UnixCommand(ShellCommand, object):
     """
     Executes a command using an Unix shell.
@@ -116,20 +786,184 @@ class UnixCommand(ShellCommand, object):
             self.command.insert(0, test_shell)
 
 
-class AttachPNG(ShellCommand):
+class ConcurrentCommand(ShellCommand):
+    """
+    Run multiple commands at the same time on the slave, with at most
+    `max_parallel` commands running at once.
+
+    `commands` is a list of dicts with `name`, `command` and `env`.
+    The output of each command is available as a separate log and the
+    step fails if any command fails.
+    """
+    renderables = ['commands']
+    haltOnFailure = True
+
+    def __init__(self, commands, max_parallel=None, python='python',
+            **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.commands = commands
+        self._max_parallel = max_parallel or len(commands)
+        self._python = python
+        self._logs = {}
+        self._failed = []
+        self.addLogObserver('stdio', _ConcurrentOutputObserver(self))
+
+    def start(self):
+        self.command = [
+            self._python, '-c', CONCURRENT_SCRIPT,
+            str(self._max_parallel),
+            json.dumps(self.commands),
+            ]
+        for command in self.commands:
+            self._logs[command['name']] = self.addLog(command['name'])
+        return ShellCommand.start(self)
+
+    def commandOutput(self, name, line):
+        """
+        Called with an output `line` of command `name`.
+        """
+        command_log = self._logs.get(name, None)
+        if command_log is None:
+            return
+        command_log.addStdout(line + '\n')
+
+    def commandDone(self, name, code, duration):
+        """
+        Called when command `name` is done, with its exit code.
+        """
+        if code != '0':
+            self._failed.append(name)
+        command_log = self._logs.pop(name, None)
+        if command_log is None:
+            return
+        command_log.addHeader(
+            'exit code %s, %s seconds\n' % (code, duration))
+        command_log.finish()
+
+    def commandComplete(self, cmd):
+        # Commands which were not done, due to timeout or interruption.
+        for command_log in self._logs.values():
+            command_log.finish()
+        self._logs = {}
+
+    def getText(self, cmd, results):
+        text = ShellCommand.getText(self, cmd, results)
+        if self._failed:
+            text = text + ['failed:'] + self._failed
+        return text
+
+
+class _ConcurrentOutputObserver(LogLineObserver):
+    """
+    Dispatch the output of ConcurrentCommand to the log of each command.
+    """
+
+    def __init__(self, step):
+        LogLineObserver.__init__(self)
+        self._step = step
+
+    def outLineReceived(self, line):
+        if line.startswith('RESULT '):
+            parts = line.rsplit(' ', 2)
+            if len(parts) == 3:
+                self._step.commandDone(parts[0][len('RESULT '):], *parts[1:])
+            return
+
+        name, separator, text = line.partition('| ')
+        if separator:
+            self._step.commandOutput(name, text)
+
+
+class ChevahGit(Git):
+    """
+    Git source step which can do shallow clones of any `depth`.
+
+    Clones using a `reference` repository copy the objects from it, so that
+    the reference repository can be updated or removed.
+    The reference is not used when slave's git is older than 2.3.
+    """
+
+    def __init__(self, depth=None, **kwargs):
+        if depth and (
+                kwargs.get('mode', 'incremental') != 'full' or
+                kwargs.get('method', None) != 'clobber'):
+            raise AssertionError(
+                'Shallow clones require full mode and clobber method.')
+        Git.__init__(self, shallow=bool(depth), **kwargs)
+        self._depth = depth
+        self.supportsDissociate = True
+
+    def checkBranchSupport(self):
+        """
+        Like upstream, also checking if clones can copy the objects from
+        the reference repository.
+        """
+        d = self._dovccmd(['--version'], collectStdout=True)
+
+        def checkSupport(stdout):
+            gitInstalled = False
+            if 'git' in stdout:
+                gitInstalled = True
+            version = stdout.strip().split(' ')[2]
+            if LooseVersion(version) < LooseVersion("1.6.5"):
+                self.supportsBranch = False
+            if LooseVersion(version) < LooseVersion("1.7.6"):
+                self.supportsSubmoduleForce = False
+            if LooseVersion(version) < LooseVersion("2.3"):
+                self.supportsDissociate = False
+            return gitInstalled
+        d.addCallback(checkSupport)
+        return d
+
+    def _dovccmd(self, command, *args, **kwargs):
+        if command and command[0] == 'clone':
+            command = command[:]
+            if self._depth and '--depth' in command:
+                command[command.index('--depth') + 1] = str(self._depth)
+            if self.reference and '--reference' in command:
+                index = command.index('--reference')
+                if self.supportsDissociate:
+                    command.insert(index, '--dissociate')
+                else:
+                    # Without copying the objects, the clone would break
+                    # when the reference is updated or removed.
+                    del command[index:index + 2]
+                    self.stdio_log.addHeader(
+                        'git older than 2.3, cloning without reference.\n')
+        return Git._dovccmd(self, command, *args, **kwargs)
+
+
+class AttachPNG(FileUpload):
     """
     Attach a PNG image from the slave build folder.
 
+    The image is uploaded as a file in the web status `public_html` folder
+    and the step has a link to it, together with a HTML log showing
+    the image or its thumbnail.
+
     This is designed to report failures, so by default it will always
-    be executed.
+    be executed. A failure to attach the image only marks the build with
+    warnings.
     """
+    haltOnFailure = False
+    flunkOnFailure = False
+    warnOnFailure = True
 
-    def __init__(self, name, source, alwaysRun=True):
+    def __init__(self, name, source, alwaysRun=True,
+            maxsize=ATTACH_PNG_MAX_SIZE, thumbnail=None):
+        if thumbnail and not Image:
+            raise AssertionError(
+                'PIL is required for attach_png thumbnails.')
         self._name = name
         self._source = source
-        ShellCommand.__init__(
+        self._thumbnail = thumbnail
+        FileUpload.__init__(
             self,
-            command='base64 %s' % (self._source,),
+            name=name,
+            slavesrc=source,
+            masterdest=None,
+            maxsize=maxsize,
+            mode=0644,
             description='attaching screen',
             descriptionDone='screen attached',
             alwaysRun=alwaysRun,
@@ -144,28 +978,730 @@ class AttachPNG(ShellCommand):
         result = result.replace('\\', '_')
         return result
 
-    def createSummary(self, log):
-        image = log.getText().strip()
-        if image.startswith('base64:'):
-            # Some kind of error while getting the image.
-            if 'No such file or directory' in image:
+    def _getAttachmentPath(self, name):
+        """
+        Return the path of attachment `name` for current build, relative to
+        the attachments root.
+        """
+        return '/'.join([
+            self._getLogName(self.getProperty('buildername')),
+            str(self.getProperty('buildnumber')),
+            self._getLogName(name),
+            ])
+
+    def _getAttachmentURL(self, name):
+        """
+        Return the URL for attachment `name` for current build.
+        """
+        return '%s%s/%s' % (
+            self.build.builder.master.config.buildbotURL,
+            ATTACHMENTS_URL,
+            self._getAttachmentPath(name),
+            )
+
+    def start(self):
+        self.masterdest = os.path.join(
+            ATTACHMENTS_PATH, self._getAttachmentPath(self._source))
+        # The link is added only once the image was uploaded.
+        self.url = None
+        self._url = self._getAttachmentURL(self._source)
+        return FileUpload.start(self)
+
+    def finished(self, result):
+        if result != SUCCESS:
+            if 'Cannot open file' in self._getOutput():
                 # No image generated... all good.
-                self.finished(SKIPPED)
-            else:
-                # There is an error.
-                self.finished(FAILURE)
-            return defer.succeed(None)
+                result = SKIPPED
+            return FileUpload.finished(self, result)
+
+        self.addURL(os.path.basename(self.masterdest), self._url)
+        deferred = self._addImageLog()
+        deferred.addCallback(lambda _: FileUpload.finished(self, SUCCESS))
+        deferred.addErrback(self.failed)
+        return deferred
+
+    def _getOutput(self):
+        """
+        Return the text of the stdio log, if any.
+        """
+        for step_log in self.step_status.getLogs():
+            if step_log.getName() == 'stdio':
+                return step_log.getText()
+        return ''
+
+    @defer.inlineCallbacks
+    def _addImageLog(self):
+        """
+        Add a HTML log showing the uploaded image, using the thumbnail when
+        configured.
+        """
+        image_url = self._url
+        if self._thumbnail:
+            name = 'thumbnail-' + self._source
+            yield threads.deferToThread(
+                self._saveThumbnail,
+                self.masterdest,
+                os.path.join(
+                    ATTACHMENTS_PATH, self._getAttachmentPath(name)),
+                )
+            image_url = self._getAttachmentURL(name)
 
         raw_html = '''
-<html><body><img src="data:image/png;base64,%s" alt="%s" scale="0">
+<html><body><a href="%s"><img src="%s" alt="%s"></a>
 </body></html>
-''' % (image, self._source)
+''' % (self._url, image_url, self._source)
         self.addHTMLLog(self._getLogName(self._source), html=raw_html)
-        self.finished(SUCCESS)
-        # The first log is the stdio, and we don't need it as we have it in
-        # HTML.
-        self._step_status.logs.pop(0)
-        return defer.succeed(None)
+
+    def _saveThumbnail(self, source, destination):
+        """
+        Save at `destination` a scaled down copy of the `source` image.
+        """
+        image = Image.open(source)
+        image.thumbnail((self._thumbnail, self._thumbnail))
+        image.save(destination, 'PNG')
+
+
+class IncrementalDirectoryUpload(_TransferBuildStep):
+    """
+    Upload a folder from slave, transferring only the files which are not
+    already on master.
+
+    Files are hashed on the slave and the new files are sent as a single
+    compressed archive to a content-addressed `store` on master.
+    `masterdest` is then created with copies of the files from the store.
+
+    Files from the store which are no longer used by any destination
+    are removed once they are older than `prune_age` seconds.
+
+    The number of bytes sent and skipped are set as the
+    `directory_upload_bytes_sent` and `directory_upload_bytes_skipped`
+    properties.
+    """
+    name = 'upload'
+
+    renderables = ['slavesrc', 'masterdest']
+
+    def __init__(self, slavesrc, masterdest, store=UPLOAD_STORE_PATH,
+            python='python', prune_age=UPLOAD_STORE_PRUNE_AGE, workdir=None,
+            **kwargs):
+        _TransferBuildStep.__init__(self, workdir=workdir, **kwargs)
+        self.slavesrc = slavesrc
+        self.masterdest = masterdest
+        self._store = store
+        self._python = python
+        self._prune_age = prune_age
+
+    def start(self):
+        self.checkSlaveVersion('shell')
+        self.checkSlaveVersion('uploadFile')
+        self.step_status.setText(['uploading', os.path.basename(
+            self.slavesrc)])
+
+        d = self._upload()
+        d.addCallback(self.finished)
+        d.addErrback(self.failed)
+
+    @defer.inlineCallbacks
+    def _upload(self):
+        """
+        Upload the folder and return the result.
+        """
+        cmd = yield self._runScript([
+            '-c', UPLOAD_HASH_SCRIPT, self.slavesrc])
+        if cmd.didFail():
+            defer.returnValue(FAILURE)
+        try:
+            manifest = self._parseManifest(cmd.stdout)
+        except ValueError as error:
+            self.addCompleteLog('manifest', '%s\n\n%s' % (error, cmd.stdout))
+            defer.returnValue(FAILURE)
+
+        missing = OrderedDict()
+        skipped = 0
+        for digest, size, path in manifest:
+            if self._useStored(digest, size):
+                skipped += size
+            else:
+                missing[digest] = path
+
+        sent = 0
+        if missing:
+            try:
+                sent = yield self._sendFiles(missing)
+            finally:
+                yield self._runScript(
+                    ['-c', UPLOAD_REMOVE_SCRIPT, UPLOAD_ARCHIVE])
+            if sent is None:
+                defer.returnValue(FAILURE)
+
+        yield threads.deferToThread(self._createDestination, manifest)
+        # The upload is done even when the store could not be cleaned.
+        yield threads.deferToThread(self._pruneStore).addErrback(
+            log.err, 'Failed to prune upload store %s' % (self._store,))
+
+        self.setProperty(
+            'directory_upload_bytes_sent', sent, 'IncrementalDirectoryUpload')
+        self.setProperty(
+            'directory_upload_bytes_skipped', skipped,
+            'IncrementalDirectoryUpload')
+        self.step_status.setText([
+            'uploaded', '%d of %d files' % (len(missing), len(manifest))])
+        defer.returnValue(SUCCESS)
+
+    @defer.inlineCallbacks
+    def _sendFiles(self, files):
+        """
+        Send `files`, a dict of digest -> path, to the store as a single
+        archive.
+
+        Return the size of the archive, or None when it failed.
+        """
+        cmd = yield self._runScript(
+            ['-c', UPLOAD_PACK_SCRIPT, self.slavesrc, UPLOAD_ARCHIVE],
+            stdin=''.join(['%s %s\n' % item for item in files.items()]),
+            )
+        if cmd.didFail():
+            defer.returnValue(None)
+
+        if not os.path.isdir(self._store):
+            os.makedirs(self._store)
+        handle, archive = tempfile.mkstemp(dir=self._store)
+        os.close(handle)
+        try:
+            result = yield self._uploadArchive(archive)
+            if result != SUCCESS:
+                defer.returnValue(None)
+            size = os.path.getsize(archive)
+            yield threads.deferToThread(
+                self._storeArchive, archive, set(files))
+        finally:
+            if os.path.exists(archive):
+                os.remove(archive)
+        defer.returnValue(size)
+
+    @defer.inlineCallbacks
+    def _runScript(self, arguments, stdin=None):
+        """
+        Run the slave Python with `arguments` and return the finished
+        command.
+        """
+        cmd = RemoteShellCommand(
+            self._getWorkdir(),
+            [self._python] + arguments,
+            collectStdout=True,
+            collectStderr=True,
+            initialStdin=stdin,
+            decodeRC={0: SUCCESS},
+            )
+        yield self.runCommand(cmd)
+        if cmd.didFail():
+            self.addCompleteLog('stderr', cmd.stderr)
+        defer.returnValue(cmd)
+
+    def _uploadArchive(self, path):
+        """
+        Upload the archive with the new files from slave to `path`.
+        """
+        writer = _FileWriter(path, None, None)
+        cmd = makeStatusRemoteCommand(self, 'uploadFile', {
+            'slavesrc': UPLOAD_ARCHIVE,
+            'workdir': self._getWorkdir(),
+            'writer': writer,
+            'maxsize': None,
+            'blocksize': 16 * 1024,
+            'keepstamp': False,
+            })
+        return self.runTransferCommand(cmd, writer)
+
+    def _parseManifest(self, output):
+        """
+        Return a list of (digest, size, path) from the hash script output.
+
+        Raise ValueError when the output can not be parsed.
+        """
+        result = []
+        for line in output.splitlines():
+            parts = line.split(' ', 2)
+            if len(parts) != 3 or not re.match('^[0-9a-f]{40}$', parts[0]):
+                raise ValueError('Invalid manifest line: %s' % (line,))
+            digest, size, path = parts
+            if '..' in path.split('/'):
+                raise ValueError('Invalid upload path: %s' % (path,))
+            result.append((digest, int(size), path))
+        return result
+
+    def _getStorePath(self, digest):
+        """
+        Return the path of file with `digest` in the store.
+        """
+        if not re.match('^[0-9a-f]{40}$', digest):
+            raise AssertionError('Invalid upload digest: %s' % (digest,))
+        return os.path.join(self._store, digest[:2], digest)
+
+    def _getReferencesPath(self, destination):
+        """
+        Return the path in the store listing the files used by
+        `destination`.
+        """
+        return os.path.join(
+            self._store, 'destinations', hashlib.sha1(destination).hexdigest())
+
+    def _useStored(self, digest, size):
+        """
+        Return True when the file with `digest` and `size` is in the store,
+        marking it as recently used.
+        """
+        path = self._getStorePath(digest)
+        try:
+            if os.path.getsize(path) != size:
+                # Changed after it was stored, so it is uploaded again.
+                return False
+            # Keep it from being pruned before the destination is created.
+            os.utime(path, None)
+        except OSError:
+            return False
+        return True
+
+    def _storeArchive(self, archive, expected):
+        """
+        Add to the store the `expected` files from `archive`.
+        """
+        with closing(tarfile.open(archive, 'r:gz')) as tar:
+            for member in tar:
+                if not member.isfile() or member.name not in expected:
+                    continue
+                path = self._getStorePath(member.name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+
+                digest = hashlib.sha1()
+                source = tar.extractfile(member)
+                handle, partial_path = tempfile.mkstemp(
+                    dir=os.path.dirname(path))
+                with os.fdopen(handle, 'wb') as target:
+                    for chunk in iter(lambda: source.read(65536), ''):
+                        digest.update(chunk)
+                        target.write(chunk)
+                if digest.hexdigest() != member.name:
+                    os.remove(partial_path)
+                    raise AssertionError(
+                        'Upload does not match digest: %s' % (member.name,))
+                os.chmod(partial_path, 0444)
+                os.rename(partial_path, path)
+
+    def _createDestination(self, manifest):
+        """
+        Replace `masterdest` with the files from `manifest`, copied from
+        the store.
+
+        Files are not linked, so that changing a published file does not
+        change the store.
+        """
+        destination = os.path.expanduser(self.masterdest).rstrip('/')
+        staging = destination + '.incoming'
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        os.makedirs(staging)
+
+        for digest, size, path in manifest:
+            target = os.path.join(staging, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            shutil.copyfile(self._getStorePath(digest), target)
+
+        if os.path.exists(destination):
+            shutil.rmtree(destination)
+        os.rename(staging, destination)
+
+        references = self._getReferencesPath(destination)
+        if not os.path.isdir(os.path.dirname(references)):
+            os.makedirs(os.path.dirname(references))
+        with open(references + '.incoming', 'wb') as stream:
+            stream.write(destination + '\n')
+            for digest in sorted(set(item[0] for item in manifest)):
+                stream.write(digest + '\n')
+        os.rename(references + '.incoming', references)
+
+    def _pruneStore(self):
+        """
+        Remove the files from the store which are not used by any
+        destination and were not used for `prune_age` seconds.
+
+        Return the number of removed files.
+        """
+        now = time.time()
+        marker = os.path.join(self._store, '.pruned')
+        try:
+            if now - os.path.getmtime(marker) < self._prune_age:
+                return 0
+        except OSError:
+            pass
+        with open(marker, 'ab'):
+            os.utime(marker, None)
+
+        used = set()
+        folder = os.path.join(self._store, 'destinations')
+        for name in os.listdir(folder) if os.path.isdir(folder) else []:
+            path = os.path.join(folder, name)
+            with open(path, 'rb') as stream:
+                lines = stream.read().splitlines()
+            if not lines or not os.path.isdir(lines[0]):
+                # Destination was removed or is not complete.
+                if now - os.path.getmtime(path) > self._prune_age:
+                    os.remove(path)
+                continue
+            used.update(lines[1:])
+
+        removed = 0
+        for base, folders, files in os.walk(self._store):
+            if base == self._store:
+                # Only look in the digest folders.
+                folders[:] = [
+                    name for name in folders
+                    if re.match('^[0-9a-f]{2}$', name)]
+            for name in files:
+                path = os.path.join(base, name)
+                if name in used or name == '.pruned':
+                    continue
+                # Leftovers from failed uploads are also removed.
+                try:
+                    if now - os.path.getmtime(path) < self._prune_age:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    # Used or removed by another upload.
+                    continue
+                removed += 1
+
+        if removed:
+            log.msg('Pruned %d files from upload store %s' % (
+                removed, self._store))
+        return removed
+
+
+class ResultCache(object):
+    """
+    Keep track of successful builds, as marker files inside `path`.
+
+    A build is identified by the project, environment and steps of its
+    builder, the source stamps and patches, and the test properties.
+    """
+
+    def __init__(self, path, ttl=RESULT_CACHE_TTL):
+        self._path = path
+        self._ttl = ttl
+
+    def getKey(self, identity, build):
+        """
+        Return the cache key for `build` or None when the build can not
+        be cached, as the revision is not known.
+        """
+        sources = []
+        for source_stamp in build.getAllSourceStamps():
+            if not source_stamp.revision:
+                return None
+
+            patch = None
+            if source_stamp.patch:
+                patch = (
+                    source_stamp.patch[0],
+                    hashlib.sha1(source_stamp.patch[1]).hexdigest(),
+                    )
+            sources.append((
+                source_stamp.codebase,
+                source_stamp.repository,
+                source_stamp.revision,
+                patch,
+                ))
+
+        properties = {}
+        for name, (value, dummy) in build.getProperties().properties.items():
+            if name == 'test' or (
+                    name.startswith('force_') and name != 'force_rebuild'):
+                properties[name] = value
+
+        return fingerprint([identity, sorted(sources), properties])
+
+    def hasSuccess(self, key):
+        """
+        Return True if a successful build was recorded for `key` in the
+        last `ttl` seconds.
+        """
+        try:
+            modified = os.path.getmtime(self._getMarkerPath(key))
+        except OSError:
+            return False
+        return time.time() - modified <= self._ttl
+
+    def addSuccess(self, key):
+        """
+        Record a successful build for `key`.
+        """
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+        with open(self._getMarkerPath(key), 'w') as marker:
+            marker.write(str(time.time()))
+
+    def _getMarkerPath(self, key):
+        return os.path.join(self._path, key)
+
+
+class CheckResultCache(BuildStep):
+    """
+    Skip all the other steps when a successful build was recorded for
+    the same sources.
+
+    The cache is not used when `force_rebuild` property is set.
+    """
+    name = 'check result cache'
+
+    def __init__(self, cache, identity, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self._cache = cache
+        self._identity = identity
+
+    def start(self):
+        if self.build.getProperty('force_rebuild'):
+            self.step_status.setText(['result cache', 'bypassed'])
+            return self.finished(SUCCESS)
+
+        key = self._cache.getKey(self._identity, self.build)
+        if not key or not self._cache.hasSuccess(key):
+            self.step_status.setText(['no cached result'])
+            return self.finished(SUCCESS)
+
+        self.step_status.setText(['result from cache'])
+        self.setProperty('result_cache_hit', key, 'CheckResultCache')
+        # Don't run the remaining steps, including the `always-run` ones.
+        del self.build.steps[:]
+        return self.finished(SUCCESS)
+
+
+class StoreResultCache(BuildStep):
+    """
+    Record the build in the result cache, if all steps were successful.
+    """
+    name = 'store result cache'
+
+    def __init__(self, cache, identity, **kwargs):
+        BuildStep.__init__(self, **kwargs)
+        self._cache = cache
+        self._identity = identity
+
+    def start(self):
+        key = self._cache.getKey(self._identity, self.build)
+        if key and self.build.result == SUCCESS:
+            self._cache.addSuccess(key)
+            self.step_status.setText(['result cached'])
+        else:
+            self.step_status.setText(['result not cached'])
+        return self.finished(SUCCESS)
+
+
+class ChevahTriggerable(Triggerable):
+    """
+    Triggerable scheduler which reports the triggered build requests as
+    soon as they are created, and not only once they are done.
+    """
+
+    def trigger(self, sourcestamps=None, set_props=None,
+            requests_created=None):
+        """
+        Same as the upstream trigger, but call `requests_created` with the
+        dict of buildername -> brid once the buildset is created.
+        """
+        props = Properties()
+        props.updateFromProperties(self.properties)
+        if set_props:
+            props.updateFromProperties(set_props)
+
+        d = self.addBuildsetForSourceStampSetDetails(
+            self.reason, sourcestamps, props)
+
+        def setup_waiter((bsid, brids)):
+            if requests_created:
+                requests_created(brids)
+            d = defer.Deferred()
+            self._waiters[bsid] = (d, brids)
+            self._updateWaiters()
+            return d
+        d.addCallback(setup_waiter)
+        return d
+
+
+class GroupTrigger(Trigger):
+    """
+    Trigger builds from a group and wait for them to finish.
+
+    With `fail_fast`, the pending and running sibling builds are cancelled
+    as soon as one of them fails.
+
+    With `max_parallel`, at most that many builds are triggered at the
+    same time and the next build is triggered as soon as one is done.
+
+    `path_filters` is a dict of scheduler name -> `paths` and `ignore_paths`
+    for the schedulers which are only triggered when the build changes
+    matching files.
+    """
+
+    def __init__(self, fail_fast=False, max_parallel=None, path_filters=None,
+            **kwargs):
+        Trigger.__init__(self, **kwargs)
+        self._fail_fast = fail_fast
+        self._path_filters = path_filters or {}
+        self._skipped = []
+        self._window = None
+        if max_parallel:
+            self._window = defer.DeferredSemaphore(max_parallel)
+        # brid -> buildername for requests which are not yet done.
+        self._triggered_requests = {}
+        self._cancelled = False
+
+    def start(self):
+        files = None
+        if self._path_filters:
+            files = getChangedFiles(self.build)
+
+        for name in self.schedulerNames:
+            path_filter = self._path_filters.get(name, None)
+            if not path_filter:
+                continue
+            if not matchPaths(files, **path_filter):
+                self._skipped.append(name)
+
+        if self._skipped:
+            self.addCompleteLog('skipped', '\n'.join(self._skipped))
+
+        if len(self._skipped) == len(self.schedulerNames):
+            # No need to trigger anything.
+            return SKIPPED
+
+        return Trigger.start(self)
+
+    def getSchedulersAndProperties(self):
+        return [
+            (name, properties)
+            for name, properties in Trigger.getSchedulersAndProperties(self)
+            if name not in self._skipped
+            ]
+
+    def getSchedulerByName(self, name):
+        scheduler = Trigger.getSchedulerByName(self, name)
+        if scheduler is None:
+            return None
+        return _GroupScheduler(self, scheduler)
+
+    def triggerScheduler(self, scheduler, sourcestamps, set_props):
+        """
+        Trigger `scheduler` once there is room in the window.
+        """
+        if self._window:
+            return self._window.run(
+                self._triggerScheduler, scheduler, sourcestamps, set_props)
+        return self._triggerScheduler(scheduler, sourcestamps, set_props)
+
+    def _triggerScheduler(self, scheduler, sourcestamps, set_props):
+        """
+        Trigger `scheduler` while keeping track of its requests.
+        """
+        if self._cancelled:
+            # A sibling has failed before this one was triggered.
+            return defer.succeed((SKIPPED, {}))
+
+        if isinstance(scheduler, ChevahTriggerable):
+            d = scheduler.trigger(
+                sourcestamps,
+                set_props=set_props,
+                requests_created=self._requestsCreated,
+                )
+        else:
+            d = scheduler.trigger(sourcestamps, set_props=set_props)
+        d.addCallback(self._triggerDone)
+        return d
+
+    def _requestsCreated(self, brids):
+        """
+        Called when the requests for a triggered scheduler are created.
+        """
+        for buildername, brid in brids.items():
+            self._triggered_requests[brid] = buildername
+
+        if self._cancelled:
+            # A sibling has already failed.
+            self._cancelTriggeredBuilds()
+
+    def _triggerDone(self, result):
+        """
+        Called when the builds of a triggered scheduler are done.
+        """
+        if not isinstance(result, tuple):
+            return result
+
+        results, brids = result
+        for brid in brids.values():
+            self._triggered_requests.pop(brid, None)
+
+        if not self._fail_fast or self._cancelled:
+            return result
+
+        if results in [FAILURE, EXCEPTION]:
+            self._cancelled = True
+            self.step_status.setText(['failed fast'])
+            self._cancelTriggeredBuilds()
+
+        return result
+
+    def _cancelTriggeredBuilds(self):
+        """
+        Cancel pending requests and stop running builds for all triggered
+        requests which are not yet done.
+        """
+        dl = []
+        for brid, buildername in self._triggered_requests.items():
+            d = self._cancelRequest(brid, buildername)
+            d.addErrback(
+                log.err, 'while cancelling build request %s' % (brid,))
+            dl.append(d)
+        return defer.DeferredList(dl)
+
+    @defer.inlineCallbacks
+    def _cancelRequest(self, brid, buildername):
+        """
+        Cancel a single request, or stop its build if already started.
+        """
+        botmaster = self.build.builder.botmaster
+        master = botmaster.parent
+
+        brdict = yield master.db.buildrequests.getBuildRequest(brid)
+        if not brdict or brdict['complete']:
+            return
+
+        if not brdict['claimed']:
+            request = yield BuildRequest.fromBrdict(master, brdict)
+            yield request.cancelBuildRequest()
+
+        builder = botmaster.builders.get(buildername, None)
+        if builder is None:
+            return
+
+        for build in builder.building:
+            if brid in [request.id for request in build.requests]:
+                build.stopBuild('Sibling build failed.')
+
+
+class _GroupScheduler(object):
+    """
+    Scheduler used by GroupTrigger to control the triggered requests.
+    """
+
+    def __init__(self, step, scheduler):
+        self._step = step
+        self._scheduler = scheduler
+        self.name = scheduler.name
+
+    def trigger(self, sourcestamps=None, set_props=None):
+        return self._step.triggerScheduler(
+            self._scheduler, sourcestamps, set_props)
 
 
 class RunStepsFactory(BuildFactory, object):
@@ -173,12 +1709,28 @@ class RunStepsFactory(BuildFactory, object):
     Run commands from 'steps'.
     """
 
-    def __init__(self, project, steps, environment):
+    def __init__(self, project, steps, environment, priority=0,
+            result_cache=None):
         super(RunStepsFactory, self).__init__()
 
         self._step_environment = environment
         self._project = project
+        self._priority = priority
+        # CACHE_COMMAND steps which are saved at the end of the build.
+        self._saved_caches = []
+
+        identity = None
+        if result_cache:
+            identity = fingerprint([project.name, environment, steps])
+            self.addStep(CheckResultCache(
+                cache=result_cache, identity=identity))
+
         self._add_steps(steps)
+        self._add_cache_saves()
+
+        if result_cache:
+            self.addStep(StoreResultCache(
+                cache=result_cache, identity=identity))
 
     def _add_steps(self, steps):
         """
@@ -208,15 +1760,46 @@ class RunStepsFactory(BuildFactory, object):
         branch = step.get('branch', None)
         config = step.get('config', None)
 
-        self.addStep(Git(
+        depth = step.get('shallow', None)
+        if depth is True:
+            depth = 1
+
+        reference = step.get('reference', None)
+        if reference is True:
+            reference = '%s/%s.git' % (GIT_MIRRORS_PATH, self._project.name)
+        if reference:
+            self._add_git_mirror(reference, step.get('python', 'python'))
+
+        self.addStep(ChevahGit(
             name='get code for ' + self._project.name,
             mode=mode,
+            method=step.get('method', None),
             repourl=self._project.repo,
             branch=branch,
-            shallow=False,
+            depth=depth,
+            reference=reference,
+            retryFetch=step.get('retry_fetch', False),
+            clobberOnFailure=step.get('clobber_on_failure', False),
             config=config,
             ))
 
+    def _add_git_mirror(self, path, python):
+        """
+        Add a step creating or updating the project's mirror at `path`,
+        using the slave's `python` command.
+
+        Builders from the same slave update the mirror one at a time.
+        """
+        self.addStep(ShellCommand(
+            name='update mirror for ' + self._project.name,
+            command=[
+                python, '-c', GIT_MIRROR_SCRIPT, self._project.repo, path],
+            description='updating mirror',
+            descriptionDone='mirror updated',
+            haltOnFailure=True,
+            locks=[SlaveLock('git-mirror-' + path).access('exclusive')],
+            ))
+
     def _add_step_slave_command(self, step):
         """
         Add a slave command step.
@@ -232,18 +1815,18 @@ class RunStepsFactory(BuildFactory, object):
 
         # Build environment variables from base environment plus
         # step specific environment variables.
-        step_environment = self._step_environment.copy()
+        step_environment = self._step_environment
         add_environment = step.get('add_environment', {})
-        step_environment.update(add_environment)
+        if add_environment:
+            step_environment = step_environment.copy()
+            step_environment.update(add_environment)
+            step_environment = internEnvironment(step_environment)
 
         done_name = name
         if optional:
             done_name = "%s (prop:force_%s)" % (name, name)
 
-        def do_step_if(step):
-            if not optional:
-                return True
-            return step.build.getProperty(force_name)
+        do_step_if = self._getDoStepIf(step, force_name)
 
         self.addStep(UnixCommand(
             name=name,
@@ -256,6 +1839,132 @@ class RunStepsFactory(BuildFactory, object):
             timeout=timeout,
             ))
 
+    def _add_step_concurrent_command(self, step):
+        """
+        Add a step running the slave commands from `steps` at the same time.
+        """
+        name = step.get('name', 'Concurrent commands')
+        optional = step.get('optional', False)
+        force_name = 'force_' + name
+
+        commands = []
+        names = set()
+        timeout = 45
+        for command in step['steps']:
+            if command.get('type', SLAVE_COMMAND) != SLAVE_COMMAND:
+                raise AssertionError(
+                    'Only slave commands can run concurrently: %s' % (
+                        command,))
+            if command['name'] in names:
+                raise AssertionError(
+                    'Duplicate concurrent command %s in %s' % (
+                        command['name'], name))
+            names.add(command['name'])
+            commands.append({
+                'name': command['name'],
+                'command': command['command'],
+                'env': command.get('add_environment', {}),
+                })
+            timeout = max(timeout, command.get('timeout', 45))
+
+        done_name = name
+        if optional:
+            done_name = "%s (prop:force_%s)" % (name, name)
+
+        self.addStep(ConcurrentCommand(
+            name=name,
+            commands=commands,
+            max_parallel=step.get('max_parallel', None),
+            python=step.get('python', 'python'),
+            doStepIf=self._getDoStepIf(step, force_name),
+            env=self._step_environment,
+            description=name,
+            descriptionDone=done_name,
+            alwaysRun=step.get('always-run', False),
+            timeout=step.get('timeout', timeout),
+            ))
+
+    def _add_step_cache_command(self, step):
+        """
+        Add a step restoring a cache shared by all builders of the slave.
+        The cache is saved at the end of the build.
+        """
+        name = step.get('name', 'cache')
+        arguments = [
+            step.get('python', 'python'), '-c', SHARED_CACHE_SCRIPT,
+            'restore',
+            step.get('cache_path', SHARED_CACHE_PATH),
+            name,
+            step['path'],
+            ] + step.get('key_files', [])
+
+        self.addStep(SetPropertyFromCommand(
+            name='restore ' + name,
+            command=arguments,
+            extract_fn=partial(extractCacheMiss, 'shared_cache_' + name),
+            env=self._step_environment,
+            description='restoring ' + name,
+            descriptionDone='restored ' + name,
+            flunkOnFailure=False,
+            warnOnFailure=True,
+            ))
+        self._saved_caches.append(step)
+
+    def _add_cache_saves(self):
+        """
+        Add steps saving the caches which were not found when restored,
+        for successful builds.
+        """
+        for step in self._saved_caches:
+            name = step.get('name', 'cache')
+            property_name = 'shared_cache_' + name
+
+            def do_step_if(build_step, property_name=property_name):
+                if build_step.build.result != SUCCESS:
+                    return False
+                return bool(build_step.build.getProperty(property_name))
+
+            self.addStep(ShellCommand(
+                name='save ' + name,
+                command=[
+                    step.get('python', 'python'), '-c', SHARED_CACHE_SCRIPT,
+                    'save',
+                    step.get('cache_path', SHARED_CACHE_PATH),
+                    name,
+                    step['path'],
+                    Interpolate('%(prop:' + property_name + ')s'),
+                    str(step.get('max_size', SHARED_CACHE_MAX_SIZE)),
+                    ],
+                env=self._step_environment,
+                doStepIf=do_step_if,
+                description='saving ' + name,
+                descriptionDone='saved ' + name,
+                flunkOnFailure=False,
+                warnOnFailure=True,
+                ))
+
+    def _getDoStepIf(self, step, force_name):
+        """
+        Return the doStepIf callable for `step`.
+
+        Optional steps are executed only when `force_name` property is set.
+        Steps with `paths` or `ignore_paths` are executed only when the build
+        changes matching files.
+        """
+        optional = step.get('optional', False)
+        paths = step.get('paths', None)
+        ignore_paths = step.get('ignore_paths', None)
+
+        def do_step_if(step):
+            if optional and not step.build.getProperty(force_name):
+                return False
+            if paths or ignore_paths:
+                return matchPaths(
+                    getChangedFiles(step.build), paths, ignore_paths)
+            return True
+
+        return do_step_if
+
     def _update_github_status(self, step, set_properties):
         """
         See if the builder should send GitHub Status.
@@ -271,18 +1980,32 @@ class RunStepsFactory(BuildFactory, object):
             "github_repo_name": parts[1],
             })
 
+    def _getTriggerProperties(self, step):
+        """
+        Return the properties set for builds triggered by `step`.
+
+        Triggered builds inherit the priority of this build.
+        """
+        set_properties = step.get('set_properties', {}).copy()
+        set_properties.setdefault(
+            'priority', Property(
+                'priority', default=self._priority, defaultWhenFalse=False))
+        self._update_github_status(step, set_properties)
+        return set_properties
+
     def _add_step_sequential_group(self, step):
         """
         Run all builders from group one after another.
         """
-        set_properties = step.get('set_properties', {})
+        set_properties = self._getTriggerProperties(step)
         copy_properties = step.get('copy_properties', [])
-        self._update_github_status(step, set_properties)
 
         target_group = step['target']
+        path_filters = self._project.getGroupMembersPathFilters(target_group)
         for target in self._project.getGroupMembersBuilderNames(target_group):
-            step = Trigger(
+            step = GroupTrigger(
                 schedulerNames=[target],
+                path_filters=path_filters,
                 waitForFinish=True,
                 updateSourceStamp=True,
                 set_properties=set_properties,
@@ -294,14 +2017,17 @@ class RunStepsFactory(BuildFactory, object):
         """
         Run all builders from group in parallel.
         """
-        set_properties = step.get('set_properties', {})
+        set_properties = self._getTriggerProperties(step)
         copy_properties = step.get('copy_properties', [])
-        self._update_github_status(step, set_properties)
 
         target_group = step['target']
         targets = self._project.getGroupMembersBuilderNames(target_group)
-        self.addStep(Trigger(
+        self.addStep(GroupTrigger(
             schedulerNames=targets,
+            fail_fast=step.get('fail_fast', False),
+            max_parallel=step.get('max_parallel', None),
+            path_filters=self._project.getGroupMembersPathFilters(
+                target_group),
             waitForFinish=True,
             updateSourceStamp=True,
             set_properties=set_properties,
@@ -336,15 +2062,27 @@ class RunStepsFactory(BuildFactory, object):
         if optional:
             done_name = "%s (prop:force_%s)" % (name, name)
 
-        def do_step_if(step):
-            if not optional:
-                return True
-            return step.build.getProperty(force_name)
+        do_step_if = self._getDoStepIf(step, force_name)
+
+        if step.get('incremental', False):
+            self.addStep(IncrementalDirectoryUpload(
+                name=done_name,
+                slavesrc=step['source'],
+                masterdest=step['destination'],
+                store=step.get('store', UPLOAD_STORE_PATH),
+                python=step.get('python', 'python'),
+                prune_age=step.get('prune_age', UPLOAD_STORE_PRUNE_AGE),
+                haltOnFailure=True,
+                doStepIf=do_step_if,
+                alwaysRun=always_run,
+                ))
+            return
 
         self.addStep(DirectoryUpload(
             name=done_name,
             slavesrc=step['source'],
             masterdest=step['destination'],
+            compress=step.get('compress', None),
             haltOnFailure=True,
             doStepIf=do_step_if,
             alwaysRun=always_run,
@@ -352,8 +2090,7 @@ class RunStepsFactory(BuildFactory, object):
 
     def _add_step_attach_png(self, step):
         """
-        Attach a PNG file as embedded HTML
-        logs.
+        Attach a PNG file uploaded to master.
         """
         name = step.get('name', 'Attach PNG')
         source = step.get('source', 'screenshot.png')
@@ -362,6 +2099,8 @@ class RunStepsFactory(BuildFactory, object):
             name=name,
             source=source,
             alwaysRun=always_run,
+            maxsize=step.get('max_size', ATTACH_PNG_MAX_SIZE),
+            thumbnail=step.get('thumbnail', None),
             ))
 
 
@@ -369,7 +2108,8 @@ class ParallelFactory(BuildFactory, object):
     """
     Trigger tests in parallel in `target_names`.
     """
-    def __init__(self, target_builder_names, steps):
+    def __init__(self, target_builder_names, steps, priority=0,
+            fail_fast=False, max_parallel=None, path_filters=None):
         super(ParallelFactory, self).__init__()
 
         copy_properties = ['test']
@@ -381,40 +2121,48 @@ class ParallelFactory(BuildFactory, object):
             if optional:
                 copy_properties.append('force_' + name)
 
-        self.addStep(Trigger(
+        self.addStep(GroupTrigger(
             schedulerNames=target_builder_names,
+            fail_fast=fail_fast,
+            max_parallel=max_parallel,
+            path_filters=path_filters,
             waitForFinish=True,
             updateSourceStamp=True,
-            set_properties={},
+            set_properties={
+                'priority': Property(
+                    'priority', default=priority, defaultWhenFalse=False),
+                },
             copy_properties=copy_properties,
             haltOnFailure=True,
             flunkOnFailure=True,
             ))
 
 
+# Name and seconds of the units used for human readable time deltas.
+TIME_DELTA_UNITS = [
+    ('days', 86400),
+    ('hours', 3600),
+    ('minutes', 60),
+    ('seconds', 1),
+    ]
+
+
 def time_delta_hr(start, end):
     """
     Return a string of human readable time delta.
     """
-    import datetime
-    from dateutil.relativedelta import relativedelta
-
-    start_date = datetime.datetime.fromtimestamp(start)
-    end_date = datetime.datetime.fromtimestamp(end)
-    delta = relativedelta(end_date, start_date)
-
-    attributes = ['years', 'months', 'days', 'hours', 'minutes', 'seconds']
+    remaining = int(end - start)
 
     result = []
-    for attribute_name in attributes:
-        attribute = getattr(delta, attribute_name)
-        if attribute > 0:
-            result.append('%d %s' % (attribute, attribute_name))
+    for name, seconds in TIME_DELTA_UNITS:
+        value, remaining = divmod(remaining, seconds)
+        if value > 0:
+            result.append('%d %s' % (value, name))
 
     return ', '.join(result)
 
 
-def message_formatter(mode, name, build, results, master_status):
+class MessageFormatter(object):
     """
     Message formater.
 
@@ -423,72 +2171,122 @@ def message_formatter(mode, name, build, results, master_status):
       * 3rd party - Triggerable(server-ubuntu-1004-x64)
       * scheduler
 
+    The body is generated one line at a time. Only the first `max_changes`
+    changes and `max_properties` properties are included. When the body
+    is larger than `max_size` characters it is truncated and ends with the
+    link to the full logs.
     """
-    from buildbot.status.builder import Results
 
-    text = []
+    def __init__(self, max_size=None, max_changes=None, max_properties=None):
+        self.max_size = max_size
+        self.max_changes = max_changes
+        self.max_properties = max_properties
+
+    def __eq__(self, other):
+        return (
+            self.__class__ == other.__class__ and
+            vars(self) == vars(other)
+            )
 
-    result = Results[results]
-    buildbot_url = master_status.getBuildbotURL()
-    reason = build.getReason()
-    full_logs_url = master_status.getURLForThing(build)
-    source_stamp = build.getSourceStamps()[0]
-    build_duration = time_delta_hr(*build.getTimes())
-    changes = build.getChanges()
-    authors = build.getResponsibleUsers()
+    def __ne__(self, other):
+        return not self == other
+
+    def __call__(self, mode, name, build, results, master_status):
+        buildbot_url = master_status.getBuildbotURL()
+        full_logs_url = master_status.getURLForThing(build)
+
+        text = []
+        size = 0
+        for line in self._getLines(build, results, full_logs_url):
+            size += len(line) + 1
+            if self.max_size and size > self.max_size:
+                text.append('')
+                text.append(
+                    'Message truncated. Full logs: %s' % (full_logs_url,))
+                break
+            text.append(line)
+
+        text.append('')
+        text.append('--')
+        text.append('Yours truly, Bill Bot.')
+        text.append(buildbot_url)
+        return {
+            'body': "\n".join(text).encode('utf-8'),
+            'type': 'plain',
+            }
 
-    properties = []
-    for key, value in build.getProperties().properties.items():
-        properties.append('%s: %s' % (key, str(value)))
+    def _getLines(self, build, results, full_logs_url):
+        """
+        Generate the lines of the message body.
+        """
+        from buildbot.status.builder import Results
 
-    steps = []
-    for step in build.getSteps():
-        step_name = "%s - %s " % (step.getName(), ' '.join(step.getText()))
-        step_results, dummy = step.getResults()
-        try:
-            step_status = Results[step_results].upper()
-            step_duration = time_delta_hr(*step.getTimes())
-        except:
-            step_status = 'UNKNOWN'
-            step_duration = 'UNKOWN'
-
-        steps.append('')
-        steps.append('Status: %s' % step_status)
-        steps.append('Step name: %s' % step_name)
-        steps.append('Duration: %s' % step_duration)
-        for key, value in step.urls.items():
-            # The space at the end is important so that the URL are
-            # recognized by email clients.
-            steps.append('%s: %s ' % (key, str(value)))
-
-    text.append('Branch: %s' % source_stamp.branch)
-    text.append('Build status: %s' % result.upper())
-    text.append('Authors: %s' % ", ".join(authors))
-    text.append('Duration: %s' % build_duration)
-    text.append('Full logs: %s' % full_logs_url)
-    text.append('Buildslave: %s' % build.getSlavename())
-    text.append('Build Reason: %s' % reason)
-    text.append('')
-    text.append('Steps details')
-    text.append('------------------------------------------------------')
-    text.extend(steps)
-    text.append('')
-    text.append('Changes')
-    text.append('------------------------------------------------------')
-    text.append('')
-    text.extend([c.asText() for c in changes])
-    text.append('')
-    text.append('Build properties')
-    text.append('------------------------------------------------------')
-    text.extend(properties)
-    text.append('')
-    text.append('--')
-    text.append('Yours truly, Bill Bot.')
-    text.append(buildbot_url)
-    return {
-        'body': "\n".join(text).encode('utf-8'),
-        'type': 'plain',
-        }
+        result = Results[results]
+        reason = build.getReason()
+        source_stamp = build.getSourceStamps()[0]
+        build_duration = time_delta_hr(*build.getTimes())
+        authors = build.getResponsibleUsers()
+
+        yield 'Branch: %s' % source_stamp.branch
+        yield 'Build status: %s' % result.upper()
+        yield 'Authors: %s' % ", ".join(authors)
+        yield 'Duration: %s' % build_duration
+        yield 'Full logs: %s' % full_logs_url
+        yield 'Buildslave: %s' % build.getSlavename()
+        yield 'Build Reason: %s' % reason
+        yield ''
+        yield 'Steps details'
+        yield '------------------------------------------------------'
+
+        for step in build.getSteps():
+            step_name = "%s - %s " % (step.getName(), ' '.join(step.getText()))
+            step_results, dummy = step.getResults()
+            try:
+                step_status = Results[step_results].upper()
+                step_duration = time_delta_hr(*step.getTimes())
+            except:
+                step_status = 'UNKNOWN'
+                step_duration = 'UNKOWN'
+
+            yield ''
+            yield 'Status: %s' % step_status
+            yield 'Step name: %s' % step_name
+            yield 'Duration: %s' % step_duration
+            for key, value in step.urls.items():
+                # The space at the end is important so that the URL are
+                # recognized by email clients.
+                yield '%s: %s ' % (key, str(value))
+
+        yield ''
+        yield 'Changes'
+        yield '------------------------------------------------------'
+        yield ''
+        changes = build.getChanges()
+        for line in self._getLimited(
+                changes, self.max_changes, 'changes',
+                lambda change: change.asText()):
+            yield line
+        yield ''
+        yield 'Build properties'
+        yield '------------------------------------------------------'
+        properties = build.getProperties().properties.items()
+        for line in self._getLimited(
+                properties, self.max_properties, 'properties',
+                lambda (key, value): '%s: %s' % (key, str(value))):
+            yield line
+
+    def _getLimited(self, items, limit, kind, format):
+        """
+        Generate the formatted lines for the first `limit` `items`.
+        """
+        for index, item in enumerate(items):
+            if limit is not None and index >= limit:
+                yield '... and %d more %s.' % (len(items) - index, kind)
+                return
+            yield format(item)
+
+
+message_formatter = MessageFormatter()
 
 
 class MailNotifier(BuildbotMailNotifier, object):
@@ -506,11 +2304,14 @@ class MailNotifier(BuildbotMailNotifier, object):
         recipients,
         user_to_email_mapper=None,
         subject=None,
+        queue=None,
+        formatter=message_formatter,
             ):
+        self._queue = queue
         kwargs = {}
         kwargs.update(server)
         kwargs.update({
-            'messageFormatter': message_formatter,
+            'messageFormatter': formatter,
             'buildSetSummary': False,
             'addPatch': False,
             'addLogs': False,
@@ -527,59 +2328,1040 @@ class MailNotifier(BuildbotMailNotifier, object):
             else:
                 kwargs['extraRecipients'].append(name)
 
-        if subject:
-            kwargs['subject'] = subject
+        if subject:
+            kwargs['subject'] = subject
+
+        if IEmailLookup.providedBy(user_to_email_mapper):
+            kwargs['lookup'] = user_to_email_mapper
+        elif user_to_email_mapper:
+            kwargs['lookup'] = DelegatedLookup(user_to_email_mapper)
+
+        super(MailNotifier, self).__init__(**kwargs)
+
+    def useLookup(self, build):
+        """
+        For "try" jobs, only send emails to the person requesting the build.
+
+        For rest, send to the list of interested users.
+        """
+        dl = []
+
+        reason = build.getReason()
+        if "'try' job by user" in reason:
+            d = defer.maybeDeferred(self.lookup.getAddress, reason)
+            dl.append(d)
+        else:
+            for u in build.getInterestedUsers():
+                d = defer.maybeDeferred(self.lookup.getAddress, u)
+                dl.append(d)
+
+        return defer.gatherResults(dl)
+
+    def sendMessage(self, m, recipients):
+        """
+        Send the message using the mail queue, when configured.
+        """
+        if not self._queue:
+            return super(MailNotifier, self).sendMessage(m, recipients)
+
+        return self._queue.add(self.fromaddr, recipients, m)
+
+
+def isPermanentSMTPError(error):
+    """
+    Return True if sending an email failing with `error` should not be
+    retried.
+    """
+    if not isinstance(error, SMTPClientError) or error.retry:
+        return False
+    return error.isFatal or error.code >= 500
+
+
+class MailQueue(object):
+    """
+    Deliver emails in batches, using a single SMTP session for all the
+    emails which are ready to be sent.
+
+    Emails are sent `batch_delay` seconds after they are queued, together
+    with the emails queued in the meantime.
+    Emails which fail with a temporary error are retried up to `retries`
+    times, waiting `retry_delay` seconds before the first retry and
+    doubling the delay for each retry.
+    With `digest`, the emails for the same recipients which are sent
+    together are delivered as a single MIME digest.
+    """
+
+    def __init__(self, server, batch_delay=MAIL_BATCH_DELAY,
+            retries=MAIL_RETRIES, retry_delay=MAIL_RETRY_DELAY,
+            digest=False, reactor=reactor):
+        self._relayhost = server['relayhost']
+        self._port = server.get('smtpPort', 25)
+        self._user = server.get('smtpUser', None)
+        self._password = server.get('smtpPassword', None)
+        self._use_tls = server.get('useTls', False)
+        self._batch_delay = batch_delay
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._digest = digest
+        self._reactor = reactor
+
+        # Queued emails, in the order in which they are sent.
+        self._pending = []
+        self._delayed_call = None
+        self._sending = False
+
+    def add(self, fromaddr, recipients, message):
+        """
+        Queue `message` and return a deferred which fires when it was
+        delivered.
+        """
+        deferred = defer.Deferred()
+        self._pending.append({
+            'from': fromaddr,
+            'to': sorted(recipients),
+            'messages': [message],
+            'deferreds': [deferred],
+            'attempt': 0,
+            'not_before': self._reactor.seconds() + self._batch_delay,
+            })
+        log.msg('Queued mail to %s' % (', '.join(sorted(recipients)),))
+        self._schedule()
+        return deferred
+
+    def _schedule(self):
+        """
+        Schedule sending the next batch, when not already sending.
+        """
+        if self._sending or not self._pending:
+            return
+
+        delay = max(0, min(
+            item['not_before'] for item in self._pending
+            ) - self._reactor.seconds())
+
+        if self._delayed_call and self._delayed_call.active():
+            if self._delayed_call.getTime() <= self._reactor.seconds() + delay:
+                return
+            self._delayed_call.cancel()
+
+        self._delayed_call = self._reactor.callLater(delay, self._send)
+
+    def _send(self):
+        """
+        Connect to the SMTP server and send all the ready emails.
+        """
+        self._delayed_call = None
+        if self._sending or not self._hasReady():
+            self._schedule()
+            return
+
+        self._sending = True
+        self._reactor.connectTCP(
+            self._relayhost, self._port, _MailQueueFactory(self))
+
+    def _hasReady(self):
+        """
+        Return True if there are emails which can be sent now.
+        """
+        now = self._reactor.seconds()
+        for item in self._pending:
+            if item['not_before'] <= now:
+                return True
+        return False
+
+    def popReady(self):
+        """
+        Return the next email which can be sent now, or None.
+        """
+        now = self._reactor.seconds()
+        ready = [item for item in self._pending if item['not_before'] <= now]
+        if not ready:
+            return None
+
+        result = ready[0]
+        self._pending.remove(result)
+        if self._digest:
+            for item in ready[1:]:
+                if item['from'] != result['from'] or item['to'] != result['to']:
+                    continue
+                self._pending.remove(item)
+                result['messages'].extend(item['messages'])
+                result['deferreds'].extend(item['deferreds'])
+                result['attempt'] = max(result['attempt'], item['attempt'])
+        return result
+
+    def getData(self, item):
+        """
+        Return the content of the email for queued `item`.
+        """
+        messages = item['messages']
+        if len(messages) == 1:
+            return messages[0].as_string()
+
+        digest = MIMEMultipart('digest')
+        for header in ['From', 'To', 'CC']:
+            if messages[0][header]:
+                digest[header] = messages[0][header]
+        digest['Subject'] = '%d build results' % (len(messages),)
+        for message in messages:
+            digest.attach(MIMEMessage(message))
+        return digest.as_string()
+
+    def sent(self, item, code, response, addresses):
+        """
+        Called when the SMTP server replied to the email for `item`.
+        """
+        if code in SMTP_SUCCESS:
+            for deferred in item['deferreds']:
+                deferred.callback((len(addresses), addresses))
+            return
+
+        error = AssertionError('SMTP error %s: %s' % (code, response))
+        if 400 <= code < 500:
+            self.failed(item, error)
+        else:
+            self._abandon(item, error)
+
+    def failed(self, item, error):
+        """
+        Called when sending the email for `item` failed.
+
+        Emails failing with a permanent SMTP error are not retried.
+        """
+        if isPermanentSMTPError(error):
+            self._abandon(item, error)
+            return
+
+        item['attempt'] += 1
+        if item['attempt'] > self._retries:
+            self._abandon(item, error)
+            return
+
+        delay = self._retry_delay * 2 ** (item['attempt'] - 1)
+        log.msg('Failed to send mail to %s: %s. Retrying in %s seconds.' % (
+            ', '.join(item['to']), error, delay))
+        item['not_before'] = self._reactor.seconds() + delay
+        self._pending.append(item)
+
+    def _abandon(self, item, error):
+        """
+        Give up on sending the email for `item`.
+        """
+        log.msg('Failed to send mail to %s: %s' % (
+            ', '.join(item['to']), error))
+        for deferred in item['deferreds']:
+            deferred.errback(error)
+
+    def connectionFailed(self, error):
+        """
+        Called when the SMTP server could not be reached.
+        """
+        self.sessionFailed(error)
+        self.disconnected()
+
+    def sessionFailed(self, error):
+        """
+        Called when the SMTP session failed before sending the emails
+        which are ready.
+        """
+        while True:
+            item = self.popReady()
+            if item is None:
+                break
+            self.failed(item, error)
+
+    def disconnected(self):
+        """
+        Called at the end of an SMTP session.
+        """
+        self._sending = False
+        self._schedule()
+
+
+class _MailQueueSender(ESMTPSender):
+    """
+    SMTP client sending all the ready emails from a MailQueue.
+    """
+
+    _item = None
+    _error = None
+
+    def getMailFrom(self):
+        self._item = self.factory.queue.popReady()
+        if self._item is None:
+            return None
+        return str(self._item['from'])
+
+    def getMailTo(self):
+        return self._item['to']
+
+    def getMailData(self):
+        return StringIO(self.factory.queue.getData(self._item))
+
+    def sentMail(self, code, resp, numOk, addresses, log):
+        item, self._item = self._item, None
+        self.factory.queue.sent(item, code, resp, addresses)
+
+    def sendError(self, exc):
+        # Only close the connection. The email is retried or abandoned
+        # when the connection is lost.
+        self._error = exc
+        SMTPClient.sendError(self, exc)
+
+    def connectionLost(self, reason):
+        ESMTPSender.connectionLost(self, reason)
+        item, self._item = self._item, None
+        error, self._error = self._error, None
+        if item is not None:
+            self.factory.queue.failed(item, error or reason.value)
+        elif error is not None:
+            # Failed before sending an email, like for authentication.
+            self.factory.queue.sessionFailed(error)
+
+
+class _MailQueueFactory(protocol.ClientFactory):
+    """
+    Create the SMTP client for a MailQueue.
+    """
+
+    domain = DNSNAME
+    protocol = _MailQueueSender
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def buildProtocol(self, addr):
+        queue = self.queue
+        result = self.protocol(
+            queue._user, queue._password, None, self.domain)
+        result.heloFallback = False
+        result.requireAuthentication = bool(queue._user and queue._password)
+        result.requireTransportSecurity = queue._use_tls
+        result.factory = self
+        return result
+
+    def clientConnectionFailed(self, connector, reason):
+        self.queue.connectionFailed(reason.value)
+
+    def clientConnectionLost(self, connector, reason):
+        self.queue.disconnected()
+
+
+class MailRouter(StatusReceiverMultiService):
+    """
+    Single status target sending the emails for all builders.
+
+    `routes` is a dict with the list of MailNotifier used for each builder
+    name. Only builders with routes are watched, and a finished build is
+    only passed to the notifiers of its builder.
+    """
+
+    compare_attrs = ['routes']
+
+    def __init__(self, routes):
+        StatusReceiverMultiService.__init__(self)
+        self.routes = routes
+        self.watched = []
+        self.master_status = None
+
+    def setServiceParent(self, parent):
+        StatusReceiverMultiService.setServiceParent(self, parent)
+        self.master_status = self.parent
+        for notifiers in self.routes.values():
+            for notifier in notifiers:
+                notifier.master_status = self.master_status
+                notifier.master = self.master_status.master
+        self.master_status.subscribe(self)
+
+    def disownServiceParent(self):
+        self.master_status.unsubscribe(self)
+        self.master_status = None
+        for builder in self.watched:
+            builder.unsubscribe(self)
+        self.watched = []
+        return StatusReceiverMultiService.disownServiceParent(self)
+
+    def builderAdded(self, name, builder):
+        if name not in self.routes:
+            return None
+
+        self.watched.append(builder)
+        return self
+
+    def buildFinished(self, name, build, results):
+        for notifier in self.routes.get(name, []):
+            notifier.buildFinished(name, build, results)
+
+
+class DelegatedLookup(object):
+    """
+    Run a method to get email address.
+
+    The method can return the address or a deferred. With `threaded` it is
+    called in the reactor thread pool.
+
+    With `cache_size`, up to `cache_size` addresses are cached for
+    `cache_ttl` seconds, dropping the least recently used ones.
+    Concurrent lookups for the same user share the same call.
+    """
+    implements(IEmailLookup)
+
+    def __init__(self, lookup, cache_size=0, cache_ttl=LOOKUP_CACHE_TTL,
+            threaded=False, reactor=reactor):
+        self._lookup = lookup
+        self._cache_size = cache_size
+        self._cache_ttl = cache_ttl
+        self._threaded = threaded
+        self._reactor = reactor
+        # Address and lookup time for each user, least recently used first.
+        self._cache = OrderedDict()
+        # Deferreds waiting for the lookup in progress for each user.
+        self._waiting = {}
+        self.hits = 0
+        self.misses = 0
+
+    def getAddress(self, user):
+        if not self._cache_size and not self._threaded:
+            return self._lookup(user)
+
+        if user in self._cache:
+            address, added = self._cache.pop(user)
+            if added + self._cache_ttl > self._reactor.seconds():
+                self._cache[user] = (address, added)
+                self.hits += 1
+                return address
+
+        self.misses += 1
+        if user in self._waiting:
+            deferred = defer.Deferred()
+            self._waiting[user].append(deferred)
+            return deferred
+
+        self._waiting[user] = []
+        if self._threaded:
+            deferred = threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                self._lookup, user)
+        else:
+            deferred = defer.maybeDeferred(self._lookup, user)
+        deferred.addBoth(self._cbLookup, user)
+        return deferred
+
+    def _cbLookup(self, result, user):
+        """
+        Cache the address for `user` and pass it to the concurrent lookups.
+        """
+        waiting = self._waiting.pop(user, [])
+        if isinstance(result, Failure):
+            for deferred in waiting:
+                deferred.errback(result)
+            return result
+
+        if self._cache_size:
+            self._cache[user] = (result, self._reactor.seconds())
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+        for deferred in waiting:
+            deferred.callback(result)
+        return result
+
+
+class LeastBusySlaveSelector(object):
+    """
+    Choose the slave with the lowest load for a builder.
+
+    The load of a slave is the number of builds running on it relative to
+    its capacity (`max_builds` multiplied by the slave `weight`), scaled by
+    how long the builder recently took on that slave compared to the
+    other slaves.
+
+    Slaves which can start a build are preferred, and slaves with the same
+    load are chosen at random.
+    """
+
+    def __init__(self, weights=None, history=SLAVE_HISTORY):
+        self._weights = weights or {}
+        self._history = history
+        # Recent duration ratio for each builder as:
+        # builder_name -> (next_build_number, {slavename: ratio})
+        self._durations = {}
+
+    def __call__(self, builder, slaves):
+        """
+        Return one of the SlaveBuilder objects from `slaves`.
+        """
+        if not slaves:
+            return None
+
+        candidates = [
+            slave_builder for slave_builder in slaves
+            if slave_builder.slave.canStartBuild()
+            ]
+        if not candidates:
+            candidates = slaves
+
+        durations = self._getDurations(builder)
+        return min(
+            candidates,
+            key=lambda slave_builder: (
+                self.getLoad(slave_builder, durations), random.random()),
+            )
+
+    def getLoad(self, slave_builder, durations):
+        """
+        Return the load of the slave once a new build is started on it.
+        """
+        slave = slave_builder.slave
+        running = len([
+            other for other in slave.slavebuilders.values()
+            if other.isBusy()
+            ])
+        capacity = (slave.max_builds or 1) * self.getWeight(slave.slavename)
+        return (
+            (running + 1.0) / capacity * durations.get(slave.slavename, 1.0))
+
+    def getWeight(self, slavename):
+        """
+        Return the configured weight for slave, defaulting to 1.
+        """
+        weight = self._weights.get(slavename, 1)
+        if weight <= 0:
+            raise AssertionError(
+                'Weight for %s should be positive.' % (slavename,))
+        return weight
+
+    def _getDurations(self, builder):
+        """
+        Return the recent build duration of `builder` on each slave, relative
+        to the average duration of the builder on all slaves.
+
+        Values are cached until a new build is started for the builder.
+        """
+        builder_status = getattr(builder, 'builder_status', None)
+        if builder_status is None:
+            return {}
+
+        marker = builder_status.nextBuildNumber
+        cached = self._durations.get(builder.name, None)
+        if cached and cached[0] == marker:
+            return cached[1]
+
+        durations = {}
+        for build in builder_status.generateFinishedBuilds(
+                num_builds=self._history):
+            start, end = build.getTimes()
+            if end is None:
+                continue
+            durations.setdefault(build.getSlavename(), []).append(end - start)
+
+        result = {}
+        all_durations = sum(durations.values(), [])
+        average = sum(all_durations) / (len(all_durations) or 1)
+        if average > 0:
+            for slavename, values in durations.items():
+                result[slavename] = sum(values) / len(values) / average
+
+        self._durations[builder.name] = (marker, result)
+        return result
+
+
+class WorkspaceAffinitySelector(object):
+    """
+    Prefer the slave which ran the last build for the same workspace, so
+    that the incremental checkout from that slave is reused.
+
+    A workspace is shared by a list of builders. Only finished builds which
+    checked out the source, having the `got_revision` property, are used.
+    Builds are read from the builder status, so the affinity is kept on
+    reconfig.
+
+    When the preferred slave can not start a build, or the last checkout
+    is older than `timeout`, the slave is chosen using `selector`.
+    """
+
+    def __init__(self, selector, timeout=AFFINITY_TIMEOUT,
+                 history=SLAVE_HISTORY):
+        self._selector = selector
+        self._timeout = timeout
+        self._history = history
+        # Last checkout for each builder as:
+        # builder_name -> (marker, (slavename, finish time))
+        self._checkouts = {}
+
+    def __call__(self, builder, slaves, builder_names):
+        """
+        Return one of the SlaveBuilder objects from `slaves`.
+        """
+        slavename, finished = self.getLastCheckout(builder, builder_names)
+        if slavename and time.time() - finished <= self._timeout:
+            for slave_builder in slaves:
+                if (slave_builder.slave.slavename == slavename and
+                        slave_builder.slave.canStartBuild()):
+                    return slave_builder
+
+        return self._selector(builder, slaves)
+
+    def getLastCheckout(self, builder, builder_names):
+        """
+        Return the slave name and the finish time of the last build which
+        checked out the source for any of `builder_names`.
+
+        Return `(None, 0)` when there is no such build.
+        """
+        builders = builder.master.botmaster.builders
+        result = (None, 0)
+        for name in builder_names:
+            if name not in builders:
+                continue
+            checkout = self._getCheckout(builders[name].builder_status)
+            if checkout[1] > result[1]:
+                result = checkout
+        return result
+
+    def _getCheckout(self, builder_status):
+        """
+        Return the last checkout for a builder.
+
+        Values are cached until a build is started or finished for the
+        builder.
+        """
+        marker = (
+            builder_status.nextBuildNumber,
+            len(builder_status.getCurrentBuilds()),
+            )
+        cached = self._checkouts.get(builder_status.getName(), None)
+        if cached and cached[0] == marker:
+            return cached[1]
+
+        result = (None, 0)
+        for build in builder_status.generateFinishedBuilds(
+                num_builds=1,
+                max_search=self._history,
+                filter_fn=lambda build: build.getProperty('got_revision'),
+                ):
+            result = (build.getSlavename(), build.getTimes()[1])
+
+        self._checkouts[builder_status.getName()] = (marker, result)
+        return result
+
+
+class ChevahGitPoller(GitPoller):
+    """
+    Patch upstream poller to reveal poll interval and branch status.
+
+    When a poll finds no new changes, the time until the next poll is
+    doubled, up to `max_poll_interval`.
+    """
+
+    compare_attrs = GitPoller.compare_attrs + ['max_poll_interval']
+
+    def __init__(self, max_poll_interval=None, **kwargs):
+        GitPoller.__init__(self, **kwargs)
+        self.max_poll_interval = max(
+            max_poll_interval or self.pollInterval, self.pollInterval)
+        self._current_interval = self.pollInterval
+
+    def describe(self):
+        status = ""
+        if not self.master:
+            status = "[STOPPED - check log]"
+        str = ('GitPoller watching at %ss the remote git repository %s, branches: %s last seen %s %s'
+                % (self._current_interval, self.repourl, ', '.join(self.branches), self.lastRev, status, ))
+        return str
+
+    @defer.inlineCallbacks
+    def poll(self):
+        previous_revisions = self.lastRev.copy()
+        yield GitPoller.poll(self)
+
+        if self.lastRev == previous_revisions:
+            self._setInterval(self._current_interval * 2)
+        else:
+            self._setInterval(self.pollInterval)
+
+    def _setInterval(self, interval):
+        """
+        Set the number of seconds until the next poll.
+        """
+        self._current_interval = min(interval, self.max_poll_interval)
+        if self._loop:
+            self._loop.interval = self._current_interval
+
+
+def normalizeRepository(url):
+    """
+    Return a canonical form for a repository URL or GitHub slug.
+    """
+    url = url.strip().lower().rstrip('/')
+    if url.endswith('.git'):
+        url = url[:-len('.git')]
+    return url
+
+
+class ChevahGitHubEventHandler(GitHubEventHandler):
+    """
+    Create changes from GitHub webhooks for the configured projects.
+
+    Changes are created for the repository URL of the projects, just like
+    the changes found by the pollers, so that they start the same
+    schedulers.
+    """
+
+    def __init__(self, secret, strict, codebase=None, repositories=None):
+        GitHubEventHandler.__init__(self, secret, strict, codebase)
+        # Repository URL and projects for each repository identifier.
+        self._repositories = repositories or {}
+        self._master = None
+
+    def process(self, request):
+        self._master = request.site.buildbot_service.master
+        return GitHubEventHandler.process(self, request)
 
-        if user_to_email_mapper:
-            kwargs['lookup'] = DelegatedLookup(user_to_email_mapper)
+    def handle_push(self, payload):
+        repository = self._getRepository(payload)
+        if repository is None:
+            return [], 'git'
 
-        super(MailNotifier, self).__init__(**kwargs)
+        changes, src = GitHubEventHandler.handle_push(self, payload)
+        self._updateChanges(changes, repository)
 
-    def useLookup(self, build):
+        match = re.match(r'^refs/heads/(.+)$', payload['ref'])
+        if changes and match:
+            self._skipPolledRevision(
+                repository[0], match.group(1), payload['after'])
+        return changes, src
+
+    def handle_pull_request(self, payload):
+        repository = self._getRepository(payload)
+        if repository is None:
+            return [], 'git'
+
+        changes, src = GitHubEventHandler.handle_pull_request(self, payload)
+        self._updateChanges(changes, repository)
+        return changes, src
+
+    def _getRepository(self, payload):
         """
-        For "try" jobs, only send emails to the person requesting the build.
+        Return the (repo, project) for the repository of the payload or
+        None when the repository is not configured.
+        """
+        repository = payload.get('repository', {})
+        for key in [
+                'full_name', 'url', 'html_url', 'clone_url', 'git_url',
+                'ssh_url']:
+            value = repository.get(key)
+            if not value:
+                continue
+            result = self._repositories.get(normalizeRepository(value))
+            if result is not None:
+                return result
 
-        For rest, send to the list of interested users.
+        log.msg('Ignoring GitHub webhook for unknown repository %s' % (
+            repository.get('full_name'),))
+        return None
+
+    def _updateChanges(self, changes, repository):
         """
-        dl = []
+        Update `changes` to match the ones created by the pollers.
+        """
+        repo, project = repository
+        for change in changes:
+            change['repository'] = repo
+            change['project'] = project
+            if change.get('category') != 'pull':
+                change['category'] = project
+
+    def _skipPolledRevision(self, repo, branch, revision):
+        """
+        Let the poller of `repo` know about `revision` so that it will not
+        create the same changes again.
+        """
+        if not self._master:
+            return
 
-        reason = build.getReason()
-        if "'try' job by user" in reason:
-            d = defer.maybeDeferred(self.lookup.getAddress, reason)
-            dl.append(d)
-        else:
-            for u in build.getInterestedUsers():
-                d = defer.maybeDeferred(self.lookup.getAddress, u)
-                dl.append(d)
+        for poller in self._master.change_svc:
+            if not isinstance(poller, ChevahGitPoller):
+                continue
+            if poller.repourl != repo or branch not in poller.branches:
+                continue
+            poller.lastRev[branch] = revision
 
-        return defer.gatherResults(dl)
 
+class StepEnvironment(dict):
+    """
+    Read-only environment variables shared by builders and steps.
 
-class DelegatedLookup(object):
+    Use `copy()` to get a dict which can be changed.
     """
-    Run a method to get email address.
+
+    def _readOnly(self, *args, **kwargs):
+        raise TypeError('Step environment is read-only.')
+
+    __setitem__ = _readOnly
+    __delitem__ = _readOnly
+    clear = _readOnly
+    pop = _readOnly
+    popitem = _readOnly
+    setdefault = _readOnly
+    update = _readOnly
+
+
+# Step environments with the same content are shared. They are released
+# once no builder uses them.
+_step_environments = weakref.WeakValueDictionary()
+
+
+def internEnvironment(environment):
     """
-    implements(IEmailLookup)
+    Return the shared StepEnvironment with the same content as
+    `environment`.
+    """
+    key = fingerprint(environment)
+    result = _step_environments.get(key)
+    if result is None:
+        result = StepEnvironment(environment)
+        _step_environments[key] = result
+    return result
 
-    def __init__(self, lookup):
-        self._lookup = lookup
 
-    def getAddress(self, user):
-        return self._lookup(user)
+def recorded(method):
+    """
+    Decorate a ConfigurationBuilder method which adds generated objects,
+    so that the call can be replayed when a configuration part is reused.
+    """
+    def wrapper(self, *args, **kwargs):
+        if self._recording is not None:
+            self._recording.append((method.__name__, args, kwargs))
+        return method(self, *args, **kwargs)
 
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
 
-class ChevahGitPoller(GitPoller):
+
+class ChevahGitHubStatus(GitHubStatus):
     """
-    Patch upstream poller to reveal poll interval and branch status.
+    Send build status to GitHub, coalescing the updates.
+
+    Updates for the same repository, revision and context which are queued
+    in `delay` seconds are sent as a single request, with the latest state.
+    Requests are sent one at a time, using a persistent connection.
+    Once the API rate limit is reached, requests are delayed until the
+    rate limit is reset.
+    When stopped, the queued updates are sent right away.
     """
 
-    def describe(self):
-        status = ""
-        if not self.master:
-            status = "[STOPPED - check log]"
-        str = ('GitPoller watching at %ss the remote git repository %s, branches: %s last seen %s %s'
-                % (self.pollInterval, self.repourl, ', '.join(self.branches), self.lastRev, status, ))
-        return str
+    def __init__(self, token, repoOwner, repoName, delay=GITHUB_STATUS_DELAY,
+            baseURL=None, reactor=reactor, **kwargs):
+        GitHubStatus.__init__(
+            self,
+            token=token,
+            repoOwner=repoOwner,
+            repoName=repoName,
+            baseURL=baseURL,
+            **kwargs
+            )
+        self._token = token
+        self._base_url = (baseURL or GITHUB_API_URL).rstrip('/')
+        self._delay = delay
+        self._reactor = reactor
+
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = 1
+        self._agent = Agent(reactor, pool=self._pool)
+
+        # Queued status for each (owner, name, sha, context).
+        self._pending = OrderedDict()
+        self._delayed_call = None
+        # Deferred for the status which is sent.
+        self._sending = None
+        self._stopping = False
+        # Time until no requests are sent, due to rate limiting.
+        self._rate_limit_reset = 0
+        self.sent = 0
+        self.coalesced = 0
+
+    def getQueueDepth(self):
+        """
+        Return the number of status updates waiting to be sent.
+        """
+        return len(self._pending)
+
+    def startService(self):
+        self._stopping = False
+        return GitHubStatus.startService(self)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        """
+        Send the queued updates and stop.
+
+        Updates which can not be sent until the rate limit is reset are
+        dropped and their deferreds fail.
+        """
+        self._stopping = True
+        if self._delayed_call and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+        if self._sending:
+            yield self._sending
+        while (self._pending and
+                self._rate_limit_reset <= self._reactor.seconds()):
+            yield self._send()
+
+        if self._pending:
+            log.msg('GitHub rate limit reached. Dropping %d status.' % (
+                self.getQueueDepth(),))
+            pending, self._pending = self._pending, OrderedDict()
+            for item in pending.values():
+                error = AssertionError(
+                    'GitHub rate limit reached. Status "%(state)s" for '
+                    '%(repoOwner)s/%(repoName)s at %(sha)s not sent.' % (
+                        item['status']))
+                for deferred in item['deferreds']:
+                    deferred.errback(error)
+
+        yield GitHubStatus.stopService(self)
+        yield self._pool.closeCachedConnections()
+
+    def _sendGitHubStatus(self, status):
+        """
+        Queue status for GitHub API.
+        """
+        key = (
+            status['repoOwner'], status['repoName'], status['sha'],
+            status['context'],
+            )
+        deferred = defer.Deferred()
+        item = self._pending.get(key)
+        if item:
+            item['status'] = status
+            item['deferreds'].append(deferred)
+            self.coalesced += 1
+        else:
+            self._pending[key] = {
+                'status': status,
+                'deferreds': [deferred],
+                'not_before': self._reactor.seconds() + self._delay,
+                }
+        self._schedule()
+        return deferred
+
+    def _schedule(self):
+        """
+        Schedule sending the next status, when not already sending.
+        """
+        if self._sending or self._stopping or not self._pending:
+            return
+
+        first = self._pending.values()[0]
+        delay = max(
+            0,
+            first['not_before'] - self._reactor.seconds(),
+            self._rate_limit_reset - self._reactor.seconds(),
+            )
+
+        if self._delayed_call and self._delayed_call.active():
+            self._delayed_call.reset(delay)
+        else:
+            self._delayed_call = self._reactor.callLater(
+                delay, self._sendNext)
+
+    def _sendNext(self):
+        """
+        Send the oldest queued status and schedule the next one.
+        """
+        self._delayed_call = None
+        self._sending = self._send()
+        self._sending.addBoth(self._sent)
+
+    def _sent(self, result):
+        self._sending = None
+        self._schedule()
+
+    @defer.inlineCallbacks
+    def _send(self):
+        """
+        Send the oldest queued status.
+        """
+        key, item = self._pending.popitem(last=False)
+        status = item['status']
+        try:
+            code = yield self._post(status)
+        except Exception as error:
+            log.err(error, 'Fail to send status "%(state)s" for '
+                '%(repoOwner)s/%(repoName)s at %(sha)s.' % status)
+            code = None
+
+        if code == 403 and self._rate_limit_reset > self._reactor.seconds():
+            # Rate limited. Send it again, unless a newer status was queued.
+            log.msg('GitHub rate limit reached. %d status queued.' % (
+                self.getQueueDepth() + 1,))
+            newer = self._pending.get(key)
+            if newer:
+                newer['deferreds'] = item['deferreds'] + newer['deferreds']
+            else:
+                self._pending = OrderedDict(
+                    [(key, item)] + self._pending.items())
+        else:
+            if code in (200, 201):
+                self.sent += 1
+                log.msg(
+                    'Status "%(state)s" sent for '
+                    '%(repoOwner)s/%(repoName)s at %(sha)s.' % status)
+            elif code is not None:
+                log.msg(
+                    'Fail to send status "%(state)s" for '
+                    '%(repoOwner)s/%(repoName)s at %(sha)s.' % status +
+                    ' HTTP %s' % (code,))
+            for deferred in item['deferreds']:
+                deferred.callback(code)
+
+    @defer.inlineCallbacks
+    def _post(self, status):
+        """
+        Post status to GitHub API and return the HTTP response code.
+        """
+        url = '%s/repos/%s/%s/statuses/%s' % (
+            self._base_url,
+            status['repoOwner'].encode('utf-8'),
+            status['repoName'].encode('utf-8'),
+            status['sha'].encode('utf-8'),
+            )
+        body = json.dumps({
+            'state': status['state'],
+            'target_url': status['targetURL'],
+            'description': status['description'],
+            'context': status['context'],
+            })
+        response = yield self._agent.request(
+            'POST',
+            url,
+            Headers({
+                'Authorization': ['token %s' % (self._token,)],
+                'Content-Type': ['application/json'],
+                'User-Agent': ['buildbot'],
+                }),
+            FileBodyProducer(StringIO(body)),
+            )
+        # Read the body, so that the connection can be reused.
+        yield readBody(response)
+        self._updateRateLimit(response.headers)
+        defer.returnValue(response.code)
+
+    def _updateRateLimit(self, headers):
+        """
+        Stop sending requests until reset when the rate limit is reached.
+        """
+        remaining = headers.getRawHeaders('x-ratelimit-remaining')
+        reset = headers.getRawHeaders('x-ratelimit-reset')
+        if not remaining or not reset:
+            return
+
+        if int(remaining[0]) <= 0:
+            self._rate_limit_reset = int(reset[0])
 
 
 class ProjectConfiguration(object):
@@ -598,6 +3380,12 @@ class ProjectConfiguration(object):
         self._github_slug =  self._raw['github_slug']
 
         self._default = self._raw.get(DEFAULT, {})
+        self._priority = self._raw.get(
+            'priority', self._parent.getDefaultPriority())
+
+        # Builder names and path filters for each group, resolved once.
+        self._group_builder_names = {}
+        self._group_path_filters = {}
 
     @property
     def name(self):
@@ -607,23 +3395,38 @@ class ProjectConfiguration(object):
     def repo(self):
         return self._repo
 
+    @property
+    def builder_names(self):
+        """
+        Names of the builders running the steps of each environment.
+        """
+        return self._all_builder_names
+
+    def setParent(self, parent):
+        """
+        Use the project with a new configuration builder.
+        """
+        self._parent = parent
+
     def addProject(self):
         """
         Add project to buildbot_configuration:
         """
         self._all_builder_names = []
+        all_builder_names = set()
 
         # Create builders after we resolve all group_builder_names.
-        for group_name, members in self._raw['groups'].items():
-            for member_name in members:
+        for group_name in self._raw['groups'].keys():
+            for member_name in self._getGroupMembers(group_name):
 
                 builder_name = self._getEnvironmentBuilderName(member_name)
                 # Don't add the same builder twice.
-                if builder_name in self._all_builder_names:
+                if builder_name in all_builder_names:
                     continue
 
                 # Create new builder for environment.
                 self._all_builder_names.append(builder_name)
+                all_builder_names.add(builder_name)
 
 
                 steps = self._getSteps(member_name)
@@ -633,15 +3436,18 @@ class ProjectConfiguration(object):
                     slavenames=slaves,
                     category=self._name,
                     nextSlave=self._nextSlave,
+                    nextBuild=nextBuild,
                     factory=RunStepsFactory(
                         project=self,
                         steps=steps,
                         environment=self._parent.getStepEnvironment(
                             member_name),
+                        priority=self._priority,
+                        result_cache=self._getResultCache(self._raw),
                         ),
                     )
 
-                self._parent.addBuilder(builder)
+                self._parent.addBuilder(builder, priority=self._priority)
 
                 # self._parent.addNotifications(
                 #     builder=builder_name,
@@ -653,6 +3459,15 @@ class ProjectConfiguration(object):
         self._addTryBuilders()
         self._addGateKeepers()
 
+    def _getResultCache(self, configuration):
+        """
+        Return the result cache for builders using `configuration` or None
+        if the cache is not enabled.
+        """
+        if not configuration.get('result_cache', False):
+            return None
+        return self._parent.getResultCache()
+
     def _getSteps(self, name):
         """
         Resolve steps.
@@ -672,19 +3487,18 @@ class ProjectConfiguration(object):
 
     def _addChangeSource(self, project, repo, branches):
         """
-        Add a GitPoller.
+        Add branches to the poller for the repository.
         """
         if not branches:
             return
 
-        self._parent.addChangeSource(ChevahGitPoller(
-            repourl=repo,
-            branches=branches,
+        self._parent.addPolledBranches(
+            repo=repo,
             project=project,
-            category=project,
-            pollinterval=POLL_INTERVAL,
-            workdir='gitpoller_%s_%s' % (project, '_'.join(branches)),
-            ))
+            branches=branches,
+            poll_interval=self._raw.get(
+                'poll_interval', self._parent.getDefaultPollInterval()),
+            )
 
     def _addTryBuilders(self):
         """
@@ -695,19 +3509,14 @@ class ProjectConfiguration(object):
 
         for group in self._raw['groups'].keys():
 
-            try:
-                target_builder_names = [
-                    self._getEnvironmentBuilderName(name)
-                    for name in self._raw['groups'][group]]
-            except KeyError:
-                raise AssertionError(
-                    'Failed to enable try group. '
-                    'No such group "%s" for project "%s"' % (group, project))
+            target_builder_names = self.getGroupMembersBuilderNames(group)
+            group_builder_name = self._getGroupBuilderName(group)
 
             if not target_builder_names:
                 raise AssertionError(
                     'There are no builders in group: %s' % group_builder_name)
-            group_builder_name = self._getGroupBuilderName(group)
+            priority = self._getGroupPriority(group)
+            group_configuration = self._getGroup(group)
 
             self._parent.addTryTarget(group_builder_name)
 
@@ -717,13 +3526,18 @@ class ProjectConfiguration(object):
                 name=group_builder_name,
                 slavenames=self._parent.getTrySlaves(),
                 nextSlave=self._nextSlave,
+                nextBuild=nextBuild,
                 factory=ParallelFactory(
                     target_builder_names=target_builder_names,
                     steps=steps,
+                    priority=priority,
+                    fail_fast=group_configuration.get('fail_fast', False),
+                    max_parallel=group_configuration.get('max_parallel', None),
+                    path_filters=self.getGroupMembersPathFilters(group),
                     ),
                 category=self._name,
                 )
-            self._parent.addBuilder(builder)
+            self._parent.addBuilder(builder, priority=priority)
 
     def _getEnvironmentBuilderName(self, name):
         """
@@ -737,13 +3551,77 @@ class ProjectConfiguration(object):
         """
         return '%s-group-%s' % (self._name, name)
 
+    def _getGroup(self, name):
+        """
+        Return the configuration for group with `name`.
+
+        A group is either a list of environments or a dict with the
+        environments as `members` and an optional `priority`.
+        """
+        try:
+            group = self._raw['groups'][name]
+        except KeyError:
+            raise AssertionError(
+                'No such group "%s" for project "%s"' % (name, self._name))
+
+        if isinstance(group, dict):
+            return group
+        return {'members': group}
+
+    def _getGroupMembers(self, name):
+        """
+        Return the environment names for group with `name`.
+        """
+        return self._getGroup(name)['members']
+
+    def _getGroupPriority(self, name):
+        """
+        Return the priority for group with `name`.
+        """
+        return self._getGroup(name).get('priority', self._priority)
+
     def getGroupMembersBuilderNames(self, name):
         """
         Return group members for group with `name`.
         """
+        if name in self._group_builder_names:
+            return self._group_builder_names[name]
+
         result = []
-        for member in  self._raw['groups'][name]:
+        for member in self._getGroupMembers(name):
             result.append(self._getEnvironmentBuilderName(member))
+        self._group_builder_names[name] = result
+        return result
+
+    def _getPathFilter(self, name):
+        """
+        Return the `paths` and `ignore_paths` filter for environment with
+        `name` or None when the environment has no filter.
+        """
+        path_filters = self._raw.get('path_filters', {})
+        path_filter = path_filters.get(name, path_filters.get(DEFAULT, None))
+        if not path_filter:
+            return None
+
+        return {
+            'paths': path_filter.get('paths', None),
+            'ignore_paths': path_filter.get('ignore_paths', None),
+            }
+
+    def getGroupMembersPathFilters(self, name):
+        """
+        Return a dict of builder name -> path filter for the members of
+        group with `name` which have a path filter.
+        """
+        if name in self._group_path_filters:
+            return self._group_path_filters[name]
+
+        result = {}
+        for member in self._getGroupMembers(name):
+            path_filter = self._getPathFilter(member)
+            if path_filter:
+                result[self._getEnvironmentBuilderName(member)] = path_filter
+        self._group_path_filters[name] = result
         return result
 
     def _addGateKeepers(self):
@@ -773,8 +3651,10 @@ class ProjectConfiguration(object):
                 stable_timer = data.get('stable_timer', STABLE_TIMER)
                 self._parent.addScheduler(SingleBranchScheduler(
                     name=builder_name,
+                    # Pollers are shared by all projects using the same
+                    # repository.
                     change_filter=ChangeFilter(
-                        project=self._name,
+                        repository=self._repo,
                         branch=scheduler,
                         ),
                     treeStableTimer=stable_timer,
@@ -794,19 +3674,23 @@ class ProjectConfiguration(object):
 
             step_environment= self._parent.getStepEnvironment(
                 data['environment'])
+            priority = data.get('priority', self._priority)
 
             self._parent.addBuilder(BuilderConfig(
                 name=builder_name,
                 slavenames=slaves,
                 nextSlave=self._nextSlave,
+                nextBuild=nextBuild,
                 factory=RunStepsFactory(
                     project=self,
                     steps=data['steps'],
                     environment=step_environment,
+                    priority=priority,
+                    result_cache=self._getResultCache(data),
                     ),
                 category=self._name,
                 properties=gatekeeper_properties,
-                ))
+                ), priority=priority)
 
             self._parent.addNotifications(
                 builder=builder_name,
@@ -827,6 +3711,8 @@ class ProjectConfiguration(object):
 
         The function should return one of the SlaveBuilder objects,
         or None if none of the available slaves should be used.
+
+        The `target-slave` property has priority over the slave selector.
         """
         request = builder.current_builder_request
         target_name = request.properties.getProperty('target-slave')
@@ -837,35 +3723,67 @@ class ProjectConfiguration(object):
                 if slave_builder.slave.slavename == target_name:
                     return slave_builder
 
-        for slave_builder in slaves:
-            if slave_builder.slave.canStartBuild():
-                return slave_builder
-
-        return random.choice(slaves)
+        return self._parent.selectSlave(builder, slaves, project=self)
 
 
 class ConfigurationBuilder(object):
     """
     Generated buildmaster configuration.
+
+    Objects generated for slaves and projects by the `previous`
+    configuration builder are reused when their configuration was not
+    changed.
     """
 
-    def __init__(self, configuration):
+    def __init__(self, configuration, previous=None):
         self._raw = configuration
 
+        # Generated objects for each configuration part, from this and
+        # from the previous configuration.
+        self._parts = {}
+        self._previous_parts = {}
+        if previous is not None:
+            self._previous_parts = previous._parts
+        # Names of the parts generated or reused from the previous
+        # configuration.
+        self.rebuilt_parts = []
+        self.reused_parts = []
+        # Calls adding objects and environments used by the part which is
+        # currently generated.
+        self._recording = None
+        self._dependencies = None
+
         change_sources_configuration = configuration.get('change_source', {})
         self.poll_interval = change_sources_configuration.get(
             'poll_interval', POLL_INTERVAL)
+        self.max_poll_interval = change_sources_configuration.get(
+            'max_poll_interval', MAX_POLL_INTERVAL)
+        # Branches to poll and interested projects for each repository.
+        self._polled_repositories = {}
+        self._webhook = change_sources_configuration.get('webhook', {})
 
 
         self._environments = self._resolveEnvironments()
+        # Step environment for each environment name.
+        self._step_environments = {}
 
         self._buildbot = self._raw['global'].copy()
         self._buildbot['status'] = []
         self._buildbot['schedulers'] = []
         self._buildbot['builders'] = []
         self._buildbot['change_source'] = []
+        self._buildbot.setdefault('prioritizeBuilders', self.prioritizeBuilders)
+        # Priority of each builder, used when sorting builders.
+        self._builder_priorities = {}
+        # Names of all builders, to reject duplicates.
+        self._builder_names = set()
 
+        self._slave_weights = {}
         self._buildbot['slaves'] = self._getBuildSlaves()
+        self._slave_selector = self._getSlaveSelector()
+        self._initSlaveAffinity()
+        self._initBuildChooser()
+        self._initResultCache()
 
         self._buildbot['status'].append(self._getWeb())
         self._buildbot['status'].extend(self._getGithHubStatus())
@@ -874,18 +3792,27 @@ class ConfigurationBuilder(object):
 
         # Builders for which to create try schedulers.
         self._try_targets = []
+        self._try_target_names = set()
 
         self._project_default = self._raw['projects'].get(DEFAULT, {})
         for project, project_configuration in self._raw['projects'].items():
             if project == DEFAULT:
                 continue
 
-            project = ProjectConfiguration(
-                project, project_configuration, self)
-            project.addProject()
+            self._addProject(project, project_configuration)
 
         # In the end create try schedulers.
         self._buildbot['schedulers'].extend(self._getTrySchedulers())
+        self._buildbot['change_source'].extend(self._getPollers())
+        self._buildbot['status'].extend(self._getMailStatus())
+
+        # Don't keep the objects which were not reused.
+        self._previous_parts = {}
+        log.msg('Configuration rebuilt %d parts, reused %d parts: %s' % (
+            len(self.rebuilt_parts),
+            len(self.reused_parts),
+            ', '.join(sorted(self.rebuilt_parts)),
+            ))
 
     @property
     def environments(self):
@@ -894,17 +3821,165 @@ class ConfigurationBuilder(object):
     def getBuidbotConfiguration(self):
         return self._buildbot.copy()
 
-    def addBuilder(self, builder):
+    def _getPreviousPart(self, name, inputs):
+        """
+        Return the part with `name` from the previous configuration or None
+        if `inputs` or the environments used by the part were changed.
+        """
+        previous = self._previous_parts.get(name)
+        if not previous or previous['fingerprint'] != inputs:
+            self.rebuilt_parts.append(name)
+            return None
+
+        for environment, environment_fingerprint in (
+                previous['dependencies'].items()):
+            if self._environment_fingerprints.get(
+                    environment) != environment_fingerprint:
+                self.rebuilt_parts.append(name)
+                return None
+
+        self.reused_parts.append(name)
+        return previous
+
+    def _addProject(self, name, configuration):
+        """
+        Add objects for project with `name`, reusing the objects from
+        the previous configuration when the project was not changed.
+        """
+        part_name = 'project:%s' % (name,)
+        inputs = fingerprint(
+            [name, configuration, self._project_default] +
+            [self._raw.get(key, {}) for key in PROJECT_ROOT_KEYS]
+            )
+        previous = self._getPreviousPart(part_name, inputs)
+
+        self._recording = []
+        self._dependencies = {}
+        if previous:
+            project = previous['project']
+            project.setParent(self)
+            self._dependencies.update(previous['dependencies'])
+            for method_name, args, kwargs in previous['calls']:
+                getattr(self, method_name)(*args, **kwargs)
+        else:
+            project = ProjectConfiguration(name, configuration, self)
+            project.addProject()
+
+        self._parts[part_name] = {
+            'fingerprint': inputs,
+            'project': project,
+            'calls': self._recording,
+            'dependencies': self._dependencies,
+            }
+        self._recording = None
+        self._dependencies = None
+
+    @recorded
+    def addBuilder(self, builder, priority=0):
+        if builder.name in self._builder_names:
+            raise AssertionError('Duplicate builder %s' % (builder.name,))
+
         self._buildbot['builders'].append(builder)
+        self._builder_names.add(builder.name)
+        self._builder_priorities[builder.name] = priority
+
+    @defer.inlineCallbacks
+    def prioritizeBuilders(self, master, builders):
+        """
+        Return `builders` sorted by priority, and then by the time of
+        the oldest pending request.
+        """
+        request_times = yield defer.gatherResults([
+            defer.maybeDeferred(builder.getOldestRequestTime)
+            for builder in builders
+            ])
+
+        def key(pair):
+            builder, request_time = pair
+            return (
+                -self._builder_priorities.get(builder.name, 0),
+                request_time is None,
+                request_time,
+                )
+
+        defer.returnValue([
+            builder for builder, dummy in sorted(
+                zip(builders, request_times), key=key)
+            ])
 
     def addChangeSource(self, change):
         self._buildbot['change_source'].append(change)
 
+    @recorded
+    def addPolledBranches(self, repo, project, branches, poll_interval):
+        """
+        Poll `branches` of `repo` for changes on behalf of `project`.
+        """
+        repository = self._polled_repositories.setdefault(repo, {
+            'projects': [],
+            'branches': [],
+            'poll_interval': poll_interval,
+            })
+        repository['projects'].append(project)
+        for branch in branches:
+            if branch not in repository['branches']:
+                repository['branches'].append(branch)
+        repository['poll_interval'] = min(
+            repository['poll_interval'], poll_interval)
+
+    def getDefaultPollInterval(self):
+        """
+        Return the poll interval for projects which don't define one.
+        """
+        return self._project_default.get('poll_interval', self.poll_interval)
+
+    def _getPollers(self):
+        """
+        Return a single poller for each polled repository.
+        """
+        result = []
+        for repo, repository in sorted(self._polled_repositories.items()):
+            projects = ','.join(sorted(repository['projects']))
+            poll_interval = repository['poll_interval']
+            if self._webhook:
+                # Changes are pushed by the webhook and polling is only
+                # used as fallback.
+                poll_interval = max(poll_interval, self.max_poll_interval)
+            result.append(ChevahGitPoller(
+                repourl=repo,
+                branches=repository['branches'],
+                project=projects,
+                category=projects,
+                pollinterval=poll_interval,
+                max_poll_interval=self.max_poll_interval,
+                workdir='gitpoller_%s' % (hashlib.sha1(repo).hexdigest(),),
+                ))
+        return result
+
+    @recorded
     def addScheduler(self, scheduler):
         self._buildbot['schedulers'].append(scheduler)
 
+    @recorded
     def addTryTarget(self, target):
+        if target in self._try_target_names:
+            return
         self._try_targets.append(target)
+        self._try_target_names.add(target)
+
+    def selectSlave(self, builder, slaves, project):
+        """
+        Return the slave on which the next build of `builder` from `project`
+        is started.
+        """
+        if not self._slave_affinity:
+            return self._slave_selector(builder, slaves)
+
+        if self._slave_affinity_mode == AFFINITY_PROJECT:
+            builder_names = project.builder_names
+        else:
+            builder_names = [builder.name]
+        return self._slave_affinity(builder, slaves, builder_names)
 
     def getTrySlaves(self):
         """
@@ -918,15 +3993,31 @@ class ConfigurationBuilder(object):
         Return slaves for environment.
         """
         try:
-            return self.environments[name]['slaves']
+            slaves = self.environments[name]['slaves']
         except KeyError:
             raise AssertionError('No such environment %s' % name)
 
+        self._useEnvironment(name)
+        return slaves
+
+    def _useEnvironment(self, name):
+        """
+        Mark environment with `name` as used by the current part.
+        """
+        if self._dependencies is not None:
+            self._dependencies[name] = self._environment_fingerprints[name]
+
+    def getDefaultPriority(self):
+        """
+        Return the default priority for projects.
+        """
+        return self._project_default.get('priority', 0)
+
     def getDefaultGateKeeperData(self):
         """
         Return default data for gatekeepers
         """
-        return self._project_default.get('gatekeepers', {})
+        return self._project_default.get('gatekeepers', {}).copy()
 
     def getDefaultSteps(self, name):
         """
@@ -961,10 +4052,96 @@ class ConfigurationBuilder(object):
             kwargs = defaults.copy()
             kwargs.update(configuration)
 
-            result.append(BuildSlave(name, **kwargs))
+            # Weight is only used for slave selection.
+            self._slave_weights[name] = kwargs.pop('weight', 1)
+
+            part_name = 'slave:%s' % (name,)
+            inputs = fingerprint([name, kwargs])
+            previous = self._getPreviousPart(part_name, inputs)
+            if previous:
+                slave = previous['slave']
+            else:
+                slave = BuildSlave(name, **kwargs)
+
+            self._parts[part_name] = {
+                'fingerprint': inputs,
+                'slave': slave,
+                'dependencies': {},
+                }
+            result.append(slave)
 
         return result
 
+    def _getSlaveSelector(self):
+        """
+        Return the callable used to choose a slave for a build.
+        """
+        configuration = self._raw.get('slave_selection', {})
+        selector = configuration.get('selector', None)
+        if selector:
+            return selector
+
+        return LeastBusySlaveSelector(
+            weights=self._slave_weights,
+            history=configuration.get('history', SLAVE_HISTORY),
+            )
+
+    def _initResultCache(self):
+        """
+        Initialize the cache for successful build results.
+        """
+        configuration = self._raw.get('result_cache', {})
+        self._result_cache = None
+        if not configuration:
+            return
+
+        self._result_cache = ResultCache(
+            path=configuration.get('path', 'result_cache'),
+            ttl=configuration.get('ttl', RESULT_CACHE_TTL),
+            )
+
+    def getResultCache(self):
+        """
+        Return the result cache.
+        """
+        if not self._result_cache:
+            raise AssertionError(
+                'The result cache is not configured. '
+                'Define the `result_cache` root key.')
+        return self._result_cache
+
+    def _initBuildChooser(self):
+        """
+        Patch the Buildbot build chooser based on the configured mode.
+        """
+        configuration = self._raw.get('slave_selection', {})
+        if configuration.get('batch', False):
+            BasicBuildChooser.popNextBuild = popNextBatchBuild
+        else:
+            BasicBuildChooser.popNextBuild = popNextBuild
+
+    def _initSlaveAffinity(self):
+        """
+        Initialize the optional workspace affinity for slave selection.
+        """
+        configuration = self._raw.get('slave_selection', {})
+        self._slave_affinity_mode = configuration.get('affinity', None)
+        self._slave_affinity = None
+
+        if not self._slave_affinity_mode:
+            return
+
+        if self._slave_affinity_mode not in [
+                AFFINITY_BUILDER, AFFINITY_PROJECT]:
+            raise AssertionError(
+                'Unknown slave affinity %s' % (self._slave_affinity_mode,))
+
+        self._slave_affinity = WorkspaceAffinitySelector(
+            selector=self._slave_selector,
+            timeout=configuration.get('affinity_timeout', AFFINITY_TIMEOUT),
+            history=configuration.get('history', SLAVE_HISTORY),
+            )
+
     def _getWeb(self):
         """
         Return a web status based on configuration.
@@ -987,7 +4164,53 @@ class ConfigurationBuilder(object):
         authz_kwargs['auth'] = htpasswd_auth
         authz_cfg = authz.Authz(**authz_kwargs)
 
-        return html.WebStatus(http_port=http_port, authz=authz_cfg)
+        return html.WebStatus(
+            http_port=http_port,
+            authz=authz_cfg,
+            change_hook_dialects=self._getChangeHookDialects(),
+            )
+
+    def _getChangeHookDialects(self):
+        """
+        Return the change hooks for the web status based on webhook
+        configuration.
+        """
+        if not self._webhook:
+            return {}
+
+        return {
+            'github': {
+                'class': partial(
+                    ChevahGitHubEventHandler,
+                    repositories=self._getWebhookRepositories(),
+                    ),
+                'secret': self._webhook.get('secret', None),
+                'strict': self._webhook.get('strict', False),
+                },
+            }
+
+    def _getWebhookRepositories(self):
+        """
+        Return the repository URL and projects for each identifier of
+        a repository from a webhook.
+        """
+        projects = {}
+        slugs = {}
+        for name, project in self._raw['projects'].items():
+            if name == DEFAULT or not project.get('repo'):
+                continue
+            projects.setdefault(project['repo'], []).append(name)
+            if project.get('github_slug'):
+                slugs[project['github_slug']] = project['repo']
+
+        result = {}
+        for repo, names in projects.items():
+            result[normalizeRepository(repo)] = (
+                repo, ','.join(sorted(names)))
+        for slug, repo in slugs.items():
+            result[normalizeRepository(slug)] = result[
+                normalizeRepository(repo)]
+        return result
 
     def _getGithHubStatus(self):
         """
@@ -1000,10 +4223,12 @@ class ConfigurationBuilder(object):
             return []
 
         result.append(
-            GitHubStatus(
+            ChevahGitHubStatus(
                 token=configuration['token'],
                 repoOwner=Interpolate("%(prop:github_repo_owner)s"),
                 repoName=Interpolate("%(prop:github_repo_name)s"),
+                delay=configuration.get('delay', GITHUB_STATUS_DELAY),
+                baseURL=configuration.get('base_url', None),
                 ))
         return result
 
@@ -1025,7 +4250,7 @@ class ConfigurationBuilder(object):
         result.append(try_scheduler)
 
         for name in self._try_targets:
-            result.append(Triggerable(name=name, builderNames=[name]))
+            result.append(ChevahTriggerable(name=name, builderNames=[name]))
 
         return result
 
@@ -1037,6 +4262,7 @@ class ConfigurationBuilder(object):
 
         default = configuration.get(DEFAULT, {})
         result = {}
+        self._environment_fingerprints = {}
         for name, data in configuration.items():
             if name == DEFAULT:
                 continue
@@ -1046,41 +4272,96 @@ class ConfigurationBuilder(object):
             else:
                 new_data.update(data)
             result[name] = new_data
+            self._environment_fingerprints[name] = fingerprint(new_data)
 
         return result
 
     def getStepEnvironment(self, name):
         """
         Return resolved environment variables.
+
+        The result is a read-only StepEnvironment shared by all the
+        builders using environment with `name`.
         """
+        self._useEnvironment(name)
+        if name in self._step_environments:
+            return self._step_environments[name]
+
         run_environment = self.environments[name].copy()
         run_environment.pop('slaves', None)
 
+        run_environment.update(PROPERTIES_ENVIRONMENT)
         run_environment.update({
             'CI': 'true',
             'BUILDBOT': 'true',
-            'COMMIT': Interpolate('%(prop:got_revision)s'),
-            'BRANCH': Interpolate('%(prop:branch)s'),
-            'BUILD_NUMBER': Interpolate('%(prop:buildnumber)s'),
-            'BUILDER_NAME': Interpolate('%(prop:buildername)s'),
-            'BUILD_DIR': Interpolate('%(prop:workdir)s'),
             'TEST_ENVIRONMENT': name,
-            'TEST_ARGUMENTS': Interpolate('%(prop:test)s'),
-
-            'CODECOV_TOKEN': Interpolate('%(prop:codecov_token)s'),
-
             'GITHUB_TOKEN': self._raw['github']['token'],
-            'GITHUB_PULL_ID': Interpolate('%(prop:github_pull_id)s'),
-            'TEST_AUTHOR': Interpolate('%(prop:author)s'),
             })
 
-        return run_environment
+        result = internEnvironment(run_environment)
+        self._step_environments[name] = result
+        return result
 
     def _initMailStatus(self):
         """
         Initialized mail status configuration
         """
         self._email = self._raw['email']
+        # Mail notifiers for each builder.
+        self._mail_routes = {}
+
+        # The objects shared by all notifiers are reused when email
+        # configuration is not changed, as the notifiers of the reused
+        # projects are still using them.
+        part_name = 'email'
+        inputs = fingerprint(self._email)
+        previous = self._getPreviousPart(part_name, inputs)
+        if previous:
+            self._user_to_email_mapper = previous['user_to_email_mapper']
+            self._message_formatter = previous['message_formatter']
+            self._mail_queue = previous['mail_queue']
+        else:
+            self._createMailShared()
+
+        self._parts[part_name] = {
+            'fingerprint': inputs,
+            'user_to_email_mapper': self._user_to_email_mapper,
+            'message_formatter': self._message_formatter,
+            'mail_queue': self._mail_queue,
+            'dependencies': {},
+            }
+
+    def _createMailShared(self):
+        """
+        Create the objects shared by all mail notifiers.
+        """
+        delivery = self._email.get('delivery', {})
+        self._user_to_email_mapper = None
+        mapper = self._email.get('user_to_email_mapper', None)
+        if mapper:
+            lookup = self._email.get('lookup', {})
+            # A single lookup is used by all notifiers to share the cache.
+            self._user_to_email_mapper = DelegatedLookup(
+                mapper,
+                cache_size=lookup.get('cache_size', 0),
+                cache_ttl=lookup.get('cache_ttl', LOOKUP_CACHE_TTL),
+                threaded=lookup.get('threaded', False),
+                )
+
+        message = self._email.get('message', {})
+        self._message_formatter = MessageFormatter(
+            max_size=message.get('max_size', None),
+            max_changes=message.get('max_changes', None),
+            max_properties=message.get('max_properties', None),
+            )
+
+        self._mail_queue = MailQueue(
+            server=self._email['server'],
+            batch_delay=delivery.get('batch_delay', MAIL_BATCH_DELAY),
+            retries=delivery.get('retries', MAIL_RETRIES),
+            retry_delay=delivery.get('retry_delay', MAIL_RETRY_DELAY),
+            digest=delivery.get('digest', False),
+            )
 
     def addNotifications(self, builder, configuration):
         """
@@ -1122,21 +4403,46 @@ class ConfigurationBuilder(object):
                 'No recipients for %s on %s.' % (builder, mode))
 
         subject = self._email.get('subject', None)
-        user_to_email_mapper = self._email.get('user_to_email_mapper', None)
 
-        self._buildbot['status'].append(MailNotifier(
+        self.addMailRoute(builder, MailNotifier(
             mode=mode,
             server=self._email['server'],
             recipients=recipients,
             builders=[builder],
-            user_to_email_mapper=user_to_email_mapper,
+            user_to_email_mapper=self._user_to_email_mapper,
             subject=subject,
+            queue=self._mail_queue,
+            formatter=self._message_formatter,
             ))
 
+    @recorded
+    def addMailRoute(self, builder, notifier):
+        """
+        Send emails for `builder` using `notifier`.
+        """
+        self._mail_routes.setdefault(builder, []).append(notifier)
+
+    def _getMailStatus(self):
+        """
+        Return the status target sending emails for all builders.
+        """
+        if not self._mail_routes:
+            return []
+        return [MailRouter(routes=self._mail_routes)]
+
+
+# Configuration builder from the last call to generate_configuration.
+_last_builder = None
+
 
 def generate_configuration(configuration):
     """
     Return configuration object for build master.
+
+    The objects generated by the previous call are reused, as master.cfg
+    is executed again on reconfig.
     """
-    builder = ConfigurationBuilder(configuration)
+    global _last_builder
+    builder = ConfigurationBuilder(configuration, previous=_last_builder)
+    _last_builder = builder
     return builder.getBuidbotConfiguration()
@@ -0,0 +1,132 @@
+"""
+Tests for attaching images to builds.
+"""
+from buildbot.status.results import FAILURE, SKIPPED, SUCCESS
+from buildbot.steps.transfer import FileUpload
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import AttachPNG
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeLog(object):
+
+    def __init__(self, text):
+        self._text = text
+
+    def getName(self):
+        return 'stdio'
+
+    def getText(self):
+        return self._text
+
+
+class FakeStepStatus(object):
+
+    def __init__(self):
+        self.logs = []
+
+    def getLogs(self):
+        return self.logs
+
+
+class TestAttachPNG(TestCase):
+    """
+    Tests for AttachPNG, without running the upload.
+    """
+
+    def setUp(self):
+        self.started = []
+        self.results = []
+        self.patch(FileUpload, 'start', lambda step: self.started.append(
+            (step.masterdest, step.url)))
+        self.patch(FileUpload, 'finished', lambda step, result: (
+            self.results.append(result)))
+
+        self.sut = AttachPNG('screens', 'out/screen.png')
+        self.sut.build = FakeObject(builder=FakeObject(master=FakeObject(
+            config=FakeObject(buildbotURL='http://build.example.com/'))))
+        properties = {'buildername': 'server-linux', 'buildnumber': 7}
+        self.sut.getProperty = properties.get
+        self.sut._step_status = FakeStepStatus()
+        self.urls = []
+        self.sut.addURL = lambda name, url: self.urls.append((name, url))
+        self.html_logs = []
+        self.sut.addHTMLLog = lambda name, html: self.html_logs.append(
+            (name, html))
+
+    def finish(self, result, output=''):
+        self.sut._step_status.logs.append(FakeLog(output))
+        return defer.maybeDeferred(self.sut.finished, result)
+
+    def test_start(self):
+        """
+        The image is uploaded to the attachments of the build, without
+        adding its link.
+        """
+        self.sut.start()
+
+        self.assertEqual([(
+            'public_html/attachments/server-linux/7/out_screen.png', None,
+            )], self.started)
+        self.assertEqual([], self.urls)
+
+    @defer.inlineCallbacks
+    def test_uploaded(self):
+        """
+        Once uploaded, the link to the image is added together with
+        a log showing it.
+        """
+        self.sut.start()
+
+        yield self.finish(SUCCESS)
+
+        url = (
+            'http://build.example.com/attachments/server-linux/7/'
+            'out_screen.png')
+        self.assertEqual([SUCCESS], self.results)
+        self.assertEqual([('out_screen.png', url)], self.urls)
+        self.assertEqual('out_screen.png', self.html_logs[0][0])
+        self.assertIn('<img src="%s"' % (url,), self.html_logs[0][1])
+
+    @defer.inlineCallbacks
+    def test_missing(self):
+        """
+        The step is skipped without a link when there is no image.
+        """
+        self.sut.start()
+
+        yield self.finish(
+            FAILURE, "Cannot open file '/slave/out/screen.png' for upload")
+
+        self.assertEqual([SKIPPED], self.results)
+        self.assertEqual([], self.urls)
+        self.assertEqual([], self.html_logs)
+
+    @defer.inlineCallbacks
+    def test_failed(self):
+        """
+        There is no link when the upload failed, like for images over the
+        maximum size.
+        """
+        self.sut.start()
+
+        yield self.finish(FAILURE, 'Maximum filesize reached')
+
+        self.assertEqual([FAILURE], self.results)
+        self.assertEqual([], self.urls)
+        self.assertEqual([], self.html_logs)
+
+    def test_failure_warns(self):
+        """
+        A failure to attach an image only adds warnings to the build.
+        """
+        self.assertFalse(self.sut.haltOnFailure)
+        self.assertFalse(self.sut.flunkOnFailure)
+        self.assertTrue(self.sut.warnOnFailure)
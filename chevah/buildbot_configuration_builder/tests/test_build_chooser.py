@@ -0,0 +1,236 @@
+"""
+Tests for matching build requests with slaves.
+"""
+from buildbot.process.buildrequestdistributor import BasicBuildChooser
+from buildbot.process.properties import Properties
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import popNextBatchBuild
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeRequest(object):
+    """
+    A pending build request.
+    """
+
+    def __init__(self, brid, priority=0, target_slave=None):
+        self.id = brid
+        self.submittedAt = brid
+        self.priority = 0
+        self.properties = Properties()
+        self.properties.setProperty('priority', priority, 'Test')
+        if target_slave:
+            self.properties.setProperty('target-slave', target_slave, 'Test')
+
+
+class FakeSlaveBuilder(object):
+
+    def __init__(self, slavename):
+        self.slave = FakeObject(slavename=slavename)
+
+    def __repr__(self):
+        return self.slave.slavename
+
+
+class FakeBuilder(object):
+    """
+    A Buildbot builder choosing the first available slave.
+    """
+
+    def __init__(self, slaves, merge=None, can_start=None, locked=()):
+        self.name = 'linux'
+        self.config = FakeObject(nextSlave=self.nextSlave, nextBuild=None)
+        self.slaves = slaves
+        self.merge = merge
+        self.can_start = can_start or (lambda slave, breq: True)
+        self.locked = locked
+        self.next_slave_calls = 0
+
+    def nextSlave(self, builder, slaves):
+        self.next_slave_calls += 1
+        return slaves[0]
+
+    def getAvailableSlaves(self):
+        return self.slaves[:]
+
+    def getMergeRequestsFn(self):
+        return self.merge
+
+    def canStartWithSlavebuilder(self, slave):
+        return slave.slave.slavename not in self.locked
+
+    def canStartBuild(self, slave, breq):
+        return defer.succeed(self.can_start(slave, breq))
+
+
+class BatchBuildChooser(BasicBuildChooser):
+    """
+    Build chooser using the batch mode, with requests from memory.
+    """
+
+    popNextBuild = popNextBatchBuild
+
+    def __init__(self, builder, requests):
+        self.requests = dict((request.id, request) for request in requests)
+        buildrequests = FakeObject(getBuildRequests=self._getBuildRequests)
+        BasicBuildChooser.__init__(
+            self, builder, FakeObject(db=FakeObject(
+                buildrequests=buildrequests)))
+        self.can_start_calls = []
+
+    def _getBuildRequests(self, buildername, claimed):
+        return defer.succeed([
+            {'brid': brid, 'submitted_at': brid} for brid in self.requests])
+
+    def _getBuildRequestForBrdict(self, brdict):
+        return defer.succeed(self.requests[brdict['brid']])
+
+    def canStartBuild(self, slave, breq):
+        self.can_start_calls.append((slave, breq.id))
+        return BasicBuildChooser.canStartBuild(self, slave, breq)
+
+
+class TestPopNextBatchBuild(TestCase):
+    """
+    Tests for the batch build chooser.
+    """
+
+    def setUp(self):
+        self.slaves = [
+            FakeSlaveBuilder('slave-1'),
+            FakeSlaveBuilder('slave-2'),
+            FakeSlaveBuilder('slave-3'),
+            ]
+
+    @defer.inlineCallbacks
+    def getBuilds(self, chooser):
+        """
+        Return all builds chosen in a pass, as (slavename, [brid]).
+        """
+        result = []
+        while True:
+            slave, breqs = yield chooser.chooseNextBuild()
+            if not slave:
+                break
+            result.append(
+                (slave.slave.slavename, [breq.id for breq in breqs]))
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def test_priority(self):
+        """
+        Requests are matched by priority and then by submission time,
+        calling nextSlave once for each request and canStartBuild only
+        for the matched pairs.
+        """
+        builder = FakeBuilder(self.slaves[:2])
+        chooser = BatchBuildChooser(builder, [
+            FakeRequest(1),
+            FakeRequest(2, priority=10),
+            FakeRequest(3),
+            ])
+
+        result = yield self.getBuilds(chooser)
+
+        self.assertEqual([('slave-1', [2]), ('slave-2', [1])], result)
+        self.assertEqual(2, builder.next_slave_calls)
+        self.assertEqual(
+            [(self.slaves[0], 2), (self.slaves[1], 1)],
+            chooser.can_start_calls)
+        self.assertEqual(2, builder.can_start_build_calls)
+
+    @defer.inlineCallbacks
+    def test_target_slave(self):
+        """
+        The slave from the `target-slave` property is used for a request,
+        when it was not matched with a previous request.
+        """
+        builder = FakeBuilder(self.slaves)
+        chooser = BatchBuildChooser(builder, [
+            FakeRequest(1),
+            FakeRequest(2, target_slave='slave-3'),
+            FakeRequest(3, target_slave='slave-1'),
+            ])
+
+        result = yield self.getBuilds(chooser)
+
+        self.assertEqual(
+            [('slave-1', [1]), ('slave-3', [2]), ('slave-2', [3])],
+            result)
+
+    @defer.inlineCallbacks
+    def test_locked_slaves(self):
+        """
+        Slaves which can not start a build for the builder are used after
+        the other slaves.
+        """
+        builder = FakeBuilder(self.slaves[:2], locked=['slave-1'])
+        chooser = BatchBuildChooser(builder, [
+            FakeRequest(1),
+            FakeRequest(2),
+            ])
+
+        result = yield self.getBuilds(chooser)
+
+        self.assertEqual([('slave-2', [1]), ('slave-1', [2])], result)
+
+    @defer.inlineCallbacks
+    def test_merged_request(self):
+        """
+        The slave matched with a request merged into a previous build is
+        used for a request which was not matched.
+        """
+        def merge(builder, breq, other):
+            return other.id == 2
+
+        builder = FakeBuilder(self.slaves[:2], merge=merge)
+        chooser = BatchBuildChooser(builder, [
+            FakeRequest(1),
+            FakeRequest(2),
+            FakeRequest(3),
+            ])
+
+        result = yield self.getBuilds(chooser)
+
+        self.assertEqual([('slave-1', [1, 2]), ('slave-2', [3])], result)
+        self.assertEqual(2, builder.can_start_build_calls)
+
+    @defer.inlineCallbacks
+    def test_can_not_start(self):
+        """
+        A request and slave rejected by canStartBuild are not used
+        for the pass.
+        """
+        builder = FakeBuilder(
+            self.slaves[:2],
+            can_start=lambda slave, breq: breq.id != 1,
+            )
+        chooser = BatchBuildChooser(builder, [
+            FakeRequest(1),
+            FakeRequest(2),
+            ])
+
+        result = yield self.getBuilds(chooser)
+
+        self.assertEqual([('slave-2', [2])], result)
+        self.assertEqual(2, builder.can_start_build_calls)
+
+    @defer.inlineCallbacks
+    def test_no_requests(self):
+        """
+        No build is started without pending requests.
+        """
+        builder = FakeBuilder(self.slaves)
+        chooser = BatchBuildChooser(builder, [])
+
+        result = yield self.getBuilds(chooser)
+
+        self.assertEqual([], result)
+        self.assertEqual([], chooser.can_start_calls)
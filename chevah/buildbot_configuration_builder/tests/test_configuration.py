@@ -0,0 +1,125 @@
+"""
+Tests for generating the buildmaster configuration.
+"""
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import (
+    ConfigurationBuilder,
+    DEFAULT,
+    SLAVE_COMMAND,
+    SOURCE_COMMAND,
+    )
+
+
+def getConfiguration(htpasswd, command='test'):
+    """
+    Return a configuration with one project.
+    """
+    return {
+        'global': {
+            'title': 'Test',
+            'db_url': 'sqlite://',
+            },
+        'try_scheduler': {
+            'port': 8087,
+            'credentials': [('user', 'pass')],
+            'environment': 'linux',
+            },
+        'github': {
+            'token': 'invalid-TOKEN',
+            },
+        'web': {
+            'port': 8080,
+            'htpasswd': htpasswd,
+            },
+        'email': {
+            'server': {
+                'fromaddr': 'buildbot@example.com',
+                'relayhost': 'smtp.example.com',
+                },
+            },
+        'slaves': {
+            DEFAULT: {'password': 'password'},
+            'slave-1': {},
+            'slave-2': {},
+            },
+        'environments': {
+            DEFAULT: {},
+            'linux': {'slaves': ['slave-1']},
+            'windows': {'slaves': ['slave-2']},
+            },
+        'projects': {
+            DEFAULT: {
+                'steps': {
+                    DEFAULT: [
+                        {'type': SOURCE_COMMAND},
+                        {
+                            'type': SLAVE_COMMAND,
+                            'name': 'test',
+                            'command': ['make', command],
+                            },
+                        ],
+                    },
+                },
+            'server': {
+                'repo': 'http://git.example.com/server.git',
+                'github_slug': 'example/server',
+                'groups': {'all': ['linux', 'windows']},
+                'gatekeepers': {},
+                },
+            },
+        }
+
+
+class TestConfigurationBuilder(TestCase):
+    """
+    Tests for reusing the objects of a previous ConfigurationBuilder.
+    """
+
+    def setUp(self):
+        self.htpasswd = self.mktemp()
+        with open(self.htpasswd, 'w') as stream:
+            stream.write('user:password\n')
+
+    def test_new(self):
+        """
+        All parts are generated without a previous configuration builder,
+        even when another builder was created before.
+        """
+        ConfigurationBuilder(getConfiguration(self.htpasswd))
+
+        sut = ConfigurationBuilder(getConfiguration(self.htpasswd))
+
+        self.assertEqual([], sut.reused_parts)
+        self.assertIn('project:server', sut.rebuilt_parts)
+
+    def test_previous(self):
+        """
+        The objects from the previous configuration builder are reused
+        when their configuration was not changed.
+        """
+        previous = ConfigurationBuilder(getConfiguration(self.htpasswd))
+
+        sut = ConfigurationBuilder(
+            getConfiguration(self.htpasswd), previous=previous)
+
+        self.assertEqual([], sut.rebuilt_parts)
+        self.assertIn('project:server', sut.reused_parts)
+        self.assertEqual(
+            previous.getBuidbotConfiguration()['slaves'],
+            sut.getBuidbotConfiguration()['slaves'],
+            )
+
+    def test_previous_changed(self):
+        """
+        A project is generated again when its steps were changed.
+        """
+        previous = ConfigurationBuilder(getConfiguration(self.htpasswd))
+
+        sut = ConfigurationBuilder(
+            getConfiguration(self.htpasswd, command='check'),
+            previous=previous,
+            )
+
+        self.assertIn('project:server', sut.rebuilt_parts)
+        self.assertNotIn('project:server', sut.reused_parts)
@@ -0,0 +1,140 @@
+"""
+Tests for the store of incremental directory uploads.
+"""
+import hashlib
+import os
+import stat
+import tarfile
+import time
+from contextlib import closing
+from StringIO import StringIO
+
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import (
+    IncrementalDirectoryUpload,
+    )
+
+
+class TestIncrementalDirectoryUpload(TestCase):
+    """
+    Tests for the store of IncrementalDirectoryUpload, without a slave.
+    """
+
+    def setUp(self):
+        self.base = self.mktemp()
+        os.makedirs(self.base)
+        self.store = os.path.join(self.base, 'store')
+        self.destination = os.path.join(self.base, 'production')
+        self.sut = IncrementalDirectoryUpload(
+            'dist', self.destination, store=self.store, prune_age=60)
+
+    def addFiles(self, *contents):
+        """
+        Add files with `contents` to the store and return the manifest
+        with `file-N` paths.
+        """
+        archive = os.path.join(self.base, 'upload.tar.gz')
+        manifest = []
+        with closing(tarfile.open(archive, 'w:gz')) as tar:
+            for index, content in enumerate(contents):
+                digest = hashlib.sha1(content).hexdigest()
+                member = tarfile.TarInfo(digest)
+                member.size = len(content)
+                tar.addfile(member, StringIO(content))
+                manifest.append((digest, len(content), 'file-%d' % (index,)))
+        self.sut._storeArchive(archive, set(item[0] for item in manifest))
+        return manifest
+
+    def age(self, path, seconds):
+        """
+        Make `path` older by `seconds`.
+        """
+        changed = os.path.getmtime(path) - seconds
+        os.utime(path, (changed, changed))
+
+    def test_storeArchive(self):
+        """
+        Files are stored by their digest as read-only.
+        """
+        manifest = self.addFiles('first', 'second')
+
+        path = self.sut._getStorePath(manifest[0][0])
+        self.assertEqual('first', open(path, 'rb').read())
+        self.assertEqual(0444, stat.S_IMODE(os.stat(path).st_mode))
+
+    def test_createDestination(self):
+        """
+        The destination has copies of the stored files, so that changing
+        them does not change the store.
+        """
+        manifest = self.addFiles('first', 'second')
+
+        self.sut._createDestination(manifest)
+
+        published = os.path.join(self.destination, 'file-0')
+        with open(published, 'ab') as stream:
+            stream.write(' changed')
+        path = self.sut._getStorePath(manifest[0][0])
+        self.assertEqual('first', open(path, 'rb').read())
+        self.assertTrue(self.sut._useStored(*manifest[0][:2]))
+
+    def test_useStored(self):
+        """
+        Only stored files with the expected size are used, and they are
+        marked as recently used.
+        """
+        manifest = self.addFiles('first')
+        digest = manifest[0][0]
+        path = self.sut._getStorePath(digest)
+        self.age(path, 100)
+
+        self.assertFalse(self.sut._useStored('0' * 40, 5))
+        self.assertFalse(self.sut._useStored(digest, 6))
+        self.assertTrue(self.sut._useStored(digest, 5))
+        self.assertTrue(time.time() - os.path.getmtime(path) < 60)
+
+    def test_pruneStore(self):
+        """
+        Old files not used by any destination are removed.
+        """
+        used = self.addFiles('used')
+        self.sut._createDestination(used)
+        unused = self.addFiles('unused', 'recent')
+        self.age(self.sut._getStorePath(used[0][0]), 100)
+        self.age(self.sut._getStorePath(unused[0][0]), 100)
+
+        self.assertEqual(1, self.sut._pruneStore())
+
+        self.assertTrue(self.sut._useStored(*used[0][:2]))
+        self.assertFalse(self.sut._useStored(*unused[0][:2]))
+        self.assertTrue(self.sut._useStored(*unused[1][:2]))
+
+    def test_pruneStore_removed_destination(self):
+        """
+        Files from a destination which no longer exists are removed.
+        """
+        manifest = self.addFiles('first')
+        self.sut._createDestination(manifest)
+        references = self.sut._getReferencesPath(self.destination)
+        self.age(references, 100)
+        self.age(self.sut._getStorePath(manifest[0][0]), 100)
+        os.rename(self.destination, self.destination + '-old')
+
+        self.assertEqual(1, self.sut._pruneStore())
+
+        self.assertFalse(os.path.exists(references))
+        self.assertFalse(self.sut._useStored(*manifest[0][:2]))
+
+    def test_pruneStore_recently(self):
+        """
+        The store is not checked again before `prune_age` seconds.
+        """
+        manifest = self.addFiles('first')
+        self.assertEqual(0, self.sut._pruneStore())
+        self.age(self.sut._getStorePath(manifest[0][0]), 100)
+
+        self.assertEqual(0, self.sut._pruneStore())
+
+        self.age(os.path.join(self.store, '.pruned'), 100)
+        self.assertEqual(1, self.sut._pruneStore())
@@ -0,0 +1,100 @@
+"""
+Tests for the Git source step.
+"""
+from buildbot.steps.source.git import Git
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import ChevahGit
+
+
+class FakeLog(object):
+
+    def __init__(self):
+        self.headers = []
+
+    def addHeader(self, text):
+        self.headers.append(text)
+
+
+class TestChevahGit(TestCase):
+    """
+    Tests for the git commands of ChevahGit, without a slave.
+    """
+
+    def setUp(self):
+        self.commands = []
+        self.version = 'git version 2.20.1\n'
+        self.patch(Git, '_dovccmd', self.dovccmd)
+        self.sut = ChevahGit(
+            repourl='git://example.com/server.git',
+            reference='../../git_mirrors/server.git',
+            mode='full',
+            method='clobber',
+            depth=10,
+            )
+        self.sut.stdio_log = FakeLog()
+
+    def dovccmd(self, step, command, *args, **kwargs):
+        self.commands.append(command)
+        if command == ['--version']:
+            return defer.succeed(self.version)
+        return defer.succeed(0)
+
+    @defer.inlineCallbacks
+    def clone(self):
+        """
+        Check the git version and clone, returning the clone command.
+        """
+        installed = yield self.sut.checkBranchSupport()
+        self.assertTrue(installed)
+        yield self.sut._dovccmd([
+            'clone', '--depth', '1',
+            '--reference', '../../git_mirrors/server.git',
+            'git://example.com/server.git', '.'])
+        defer.returnValue(self.commands[-1])
+
+    @defer.inlineCallbacks
+    def test_clone_dissociate(self):
+        """
+        Clones copy the objects from the reference and use the
+        configured depth.
+        """
+        command = yield self.clone()
+
+        self.assertEqual([
+            'clone', '--depth', '10',
+            '--dissociate', '--reference', '../../git_mirrors/server.git',
+            'git://example.com/server.git', '.',
+            ], command)
+        self.assertEqual([], self.sut.stdio_log.headers)
+
+    @defer.inlineCallbacks
+    def test_clone_old_git(self):
+        """
+        With git older than 2.3 the reference is not used.
+        """
+        self.version = 'git version 2.1.4\n'
+
+        command = yield self.clone()
+
+        self.assertEqual([
+            'clone', '--depth', '10', 'git://example.com/server.git', '.',
+            ], command)
+        self.assertEqual(
+            ['git older than 2.3, cloning without reference.\n'],
+            self.sut.stdio_log.headers)
+        self.assertTrue(self.sut.supportsBranch)
+
+    @defer.inlineCallbacks
+    def test_checkBranchSupport_upstream(self):
+        """
+        Upstream features are still checked.
+        """
+        self.version = 'git version 1.7.1\n'
+
+        yield self.sut.checkBranchSupport()
+
+        self.assertTrue(self.sut.supportsBranch)
+        self.assertFalse(self.sut.supportsSubmoduleForce)
+        self.assertFalse(self.sut.supportsDissociate)
@@ -0,0 +1,268 @@
+"""
+Tests for sending build status to GitHub.
+"""
+import json
+import time
+
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+
+from chevah.buildbot_configuration_builder.builder import ChevahGitHubStatus
+
+
+class FakeStatusesResource(Resource):
+    """
+    Stand-in for the statuses API of GitHub.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.requests = []
+        self.rate_limit_reset = None
+        self.paused = None
+        self.received = defer.Deferred()
+
+    def render_POST(self, request):
+        self.requests.append({
+            'path': request.path,
+            'authorization': request.getHeader('authorization'),
+            'body': json.loads(request.content.read()),
+            })
+        received, self.received = self.received, defer.Deferred()
+        received.callback(None)
+
+        if self.rate_limit_reset:
+            request.setResponseCode(403)
+            request.setHeader('X-RateLimit-Remaining', '0')
+            request.setHeader(
+                'X-RateLimit-Reset', str(self.rate_limit_reset))
+            return '{"message": "API rate limit exceeded"}'
+
+        request.setResponseCode(201)
+        request.setHeader('X-RateLimit-Remaining', '4999')
+        request.setHeader('X-RateLimit-Reset', str(int(time.time())))
+        if self.paused is None:
+            return '{}'
+
+        # Reply once the test resumes the request.
+        def reply(dummy):
+            request.write('{}')
+            request.finish()
+        self.paused.addCallback(reply)
+        return NOT_DONE_YET
+
+
+class CountingSite(Site):
+    """
+    Site counting the connections.
+    """
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return Site.buildProtocol(self, addr)
+
+
+class FakeStatus(object):
+
+    def subscribe(self, receiver):
+        pass
+
+    def unsubscribe(self, receiver):
+        pass
+
+
+class FakeParent(object):
+
+    def getStatus(self):
+        return FakeStatus()
+
+
+def getStatus(context='linux', state='pending', sha='abc123'):
+    return {
+        'repoOwner': u'chevah',
+        'repoName': u'server',
+        'sha': sha,
+        'context': context,
+        'state': state,
+        'targetURL': 'http://build.example.com/builders/linux/builds/1',
+        'description': 'Build done.',
+        }
+
+
+class TestChevahGitHubStatus(TestCase):
+    """
+    Tests for ChevahGitHubStatus, sending to a local API stand-in.
+    """
+
+    def setUp(self):
+        self.api = FakeStatusesResource()
+        self.site = CountingSite(self.api)
+        port = reactor.listenTCP(0, self.site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.base_url = 'http://127.0.0.1:%d' % (port.getHost().port,)
+
+    def getSUT(self, delay=0):
+        """
+        Return a started status target.
+        """
+        sut = ChevahGitHubStatus(
+            token='TOKEN',
+            repoOwner='chevah',
+            repoName='server',
+            delay=delay,
+            baseURL=self.base_url,
+            )
+        sut.parent = FakeParent()
+        sut.startService()
+        self.addCleanup(sut._pool.closeCachedConnections)
+        return sut
+
+    def sendNext(self, sut):
+        """
+        Send the next queued status now and return the deferred for
+        its request.
+        """
+        sut._delayed_call.cancel()
+        sut._sendNext()
+        return sut._sending
+
+    @defer.inlineCallbacks
+    def test_send(self):
+        """
+        Status is posted to the API for the repository and revision.
+        """
+        sut = self.getSUT()
+
+        result = yield sut._sendGitHubStatus(getStatus())
+
+        self.assertEqual(201, result)
+        self.assertEqual(1, sut.sent)
+        self.assertEqual(0, sut.getQueueDepth())
+        self.assertEqual(
+            '/repos/chevah/server/statuses/abc123',
+            self.api.requests[0]['path'])
+        self.assertEqual('token TOKEN', self.api.requests[0]['authorization'])
+        self.assertEqual({
+            'state': 'pending',
+            'context': 'linux',
+            'description': 'Build done.',
+            'target_url': 'http://build.example.com/builders/linux/builds/1',
+            }, self.api.requests[0]['body'])
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        """
+        Updates for the same revision and context are sent as a single
+        request with the latest state, using a single connection.
+        """
+        sut = self.getSUT()
+
+        results = yield defer.gatherResults([
+            sut._sendGitHubStatus(getStatus()),
+            sut._sendGitHubStatus(getStatus(context='windows')),
+            sut._sendGitHubStatus(getStatus(state='success')),
+            sut._sendGitHubStatus(getStatus(sha='def456')),
+            ])
+
+        self.assertEqual([201, 201, 201, 201], results)
+        self.assertEqual(3, len(self.api.requests))
+        self.assertEqual(
+            ('linux', 'success'),
+            (self.api.requests[0]['body']['context'],
+                self.api.requests[0]['body']['state']))
+        self.assertEqual(
+            'windows', self.api.requests[1]['body']['context'])
+        self.assertEqual(3, sut.sent)
+        self.assertEqual(1, sut.coalesced)
+        self.assertEqual(1, self.site.connections)
+
+    @defer.inlineCallbacks
+    def test_rate_limit(self):
+        """
+        Once the rate limit is reached, the status is sent again after
+        the rate limit reset.
+        """
+        sut = self.getSUT()
+        reset = int(time.time()) + 3600
+        self.api.rate_limit_reset = reset
+        sut._sendGitHubStatus(getStatus())
+        yield self.sendNext(sut)
+        self.addCleanup(lambda: sut._delayed_call.cancel())
+
+        self.assertEqual(1, len(self.api.requests))
+        self.assertEqual(1, sut.getQueueDepth())
+        self.assertApproximates(reset, sut._delayed_call.getTime(), 0.1)
+
+        # An update queued in the meantime replaces the queued one.
+        sut._sendGitHubStatus(getStatus(state='success'))
+        self.assertEqual(1, sut.getQueueDepth())
+        self.assertApproximates(reset, sut._delayed_call.getTime(), 0.1)
+
+    @defer.inlineCallbacks
+    def test_stop_flush(self):
+        """
+        The queued updates are sent when the service is stopped, without
+        waiting for the delay.
+        """
+        sut = self.getSUT(delay=60)
+        first = sut._sendGitHubStatus(getStatus())
+        second = sut._sendGitHubStatus(getStatus(context='windows'))
+
+        yield sut.stopService()
+
+        self.assertEqual(2, len(self.api.requests))
+        self.assertEqual(201, (yield first))
+        self.assertEqual(201, (yield second))
+        self.assertEqual(0, sut.getQueueDepth())
+        self.assertEqual(None, sut._delayed_call)
+
+    @defer.inlineCallbacks
+    def test_stop_sending(self):
+        """
+        The status which is sent is finished before sending the other
+        queued updates and stopping.
+        """
+        sut = self.getSUT()
+        self.api.paused = defer.Deferred()
+        first = sut._sendGitHubStatus(getStatus())
+        self.sendNext(sut)
+        yield self.api.received
+        second = sut._sendGitHubStatus(getStatus(context='windows'))
+
+        stopped = sut.stopService()
+        self.assertNoResult(stopped)
+        self.api.paused.callback(None)
+        yield stopped
+
+        self.assertEqual(2, len(self.api.requests))
+        self.assertEqual(201, (yield first))
+        self.assertEqual(201, (yield second))
+
+    @defer.inlineCallbacks
+    def test_stop_rate_limit(self):
+        """
+        The queued updates which can not be sent until the rate limit is
+        reset fail when the service is stopped.
+        """
+        sut = self.getSUT()
+        self.api.rate_limit_reset = int(time.time()) + 3600
+        first = sut._sendGitHubStatus(getStatus())
+        yield self.sendNext(sut)
+        second = sut._sendGitHubStatus(getStatus(context='windows'))
+
+        yield sut.stopService()
+
+        self.assertEqual(1, len(self.api.requests))
+        self.assertEqual(0, sut.getQueueDepth())
+        yield self.assertFailure(first, AssertionError)
+        error = yield self.assertFailure(second, AssertionError)
+        self.assertEqual(
+            'GitHub rate limit reached. Status "pending" for '
+            'chevah/server at abc123 not sent.',
+            str(error))
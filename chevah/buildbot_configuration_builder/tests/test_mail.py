@@ -0,0 +1,325 @@
+"""
+Tests for delivering emails in batches.
+"""
+import base64
+from email.mime.text import MIMEText
+
+from twisted.internet import defer, protocol, reactor
+from twisted.internet.task import Clock
+from twisted.mail.smtp import AUTHDeclinedError, SMTPClientError
+from twisted.protocols.basic import LineReceiver
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import (
+    MailQueue,
+    isPermanentSMTPError,
+    )
+
+
+class FakeSMTPServer(LineReceiver):
+    """
+    SMTP server replying with the codes configured in the factory.
+    """
+
+    def connectionMade(self):
+        self.factory.connections += 1
+        self._data = None
+        self._mail = None
+        self.sendLine('220 localhost ESMTP')
+
+    def lineReceived(self, line):
+        if self._data is not None:
+            if line != '.':
+                self._data.append(line)
+                return
+            self._mail['data'] = '\n'.join(self._data)
+            self._data = None
+            code = self.factory.data_codes.pop(0)
+            if code == 250:
+                self.factory.mails.append(self._mail)
+            self.sendLine('%d Done' % (code,))
+            return
+
+        command = line.split(' ', 1)[0].upper()
+        if command == 'EHLO':
+            if self.factory.credentials:
+                self.sendLine('250-localhost')
+                self.sendLine('250 AUTH PLAIN')
+            else:
+                self.sendLine('250 localhost')
+        elif command == 'AUTH':
+            response = base64.b64decode(line.split()[-1])
+            user, password = response.split('\0')[-2:]
+            if (user, password) == self.factory.credentials:
+                self.sendLine('235 Authenticated')
+            else:
+                self.sendLine('535 Invalid credentials')
+        elif command == 'MAIL':
+            self._mail = {'from': line[len('MAIL FROM:'):], 'to': []}
+            self.sendLine('250 OK')
+        elif command == 'RCPT':
+            self._mail['to'].append(line[len('RCPT TO:'):])
+            self.sendLine('250 OK')
+        elif command == 'DATA':
+            self._data = []
+            self.sendLine('354 Continue')
+        elif command == 'RSET':
+            self.sendLine('250 OK')
+        elif command == 'QUIT':
+            self.sendLine('221 Bye')
+            self.transport.loseConnection()
+        else:
+            self.sendLine('500 Unknown command')
+
+
+class FakeSMTPFactory(protocol.ServerFactory):
+
+    protocol = FakeSMTPServer
+
+    def __init__(self, data_codes=(), credentials=None):
+        self.connections = 0
+        self.mails = []
+        self.data_codes = list(data_codes)
+        self.credentials = credentials
+
+
+class FakeReactor(object):
+    """
+    Reactor with a fake clock, connecting to real servers.
+    """
+
+    def __init__(self):
+        self.clock = Clock()
+        self.seconds = self.clock.seconds
+        self.callLater = self.clock.callLater
+
+    def connectTCP(self, *args, **kwargs):
+        return reactor.connectTCP(*args, **kwargs)
+
+
+class SessionMailQueue(MailQueue):
+    """
+    MailQueue which lets tests wait for the end of an SMTP session.
+    """
+
+    def __init__(self, *args, **kwargs):
+        MailQueue.__init__(self, *args, **kwargs)
+        self.sessions = []
+
+    def disconnected(self):
+        MailQueue.disconnected(self)
+        waiting, self.sessions = self.sessions, []
+        for deferred in waiting:
+            deferred.callback(None)
+
+    def waitSession(self):
+        deferred = defer.Deferred()
+        self.sessions.append(deferred)
+        return deferred
+
+
+def getMessage(text, to='dev@example.com'):
+    message = MIMEText(text)
+    message['From'] = 'buildbot@example.com'
+    message['To'] = to
+    message['Subject'] = text
+    return message
+
+
+class TestMailQueue(TestCase):
+    """
+    Tests for MailQueue, sending to a local SMTP server.
+    """
+
+    def getQueue(self, factory, user=None, password=None, **kwargs):
+        """
+        Return a queue sending emails to a server from `factory`.
+        """
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        self.reactor = FakeReactor()
+        server = {
+            'relayhost': '127.0.0.1',
+            'smtpPort': port.getHost().port,
+            }
+        if user:
+            server['smtpUser'] = user
+            server['smtpPassword'] = password
+        kwargs.setdefault('batch_delay', 1)
+        kwargs.setdefault('retry_delay', 10)
+        return SessionMailQueue(server, reactor=self.reactor, **kwargs)
+
+    def add(self, queue, text, to='dev@example.com'):
+        """
+        Queue an email and return a list with its result.
+        """
+        result = []
+        deferred = queue.add(
+            'buildbot@example.com', [to], getMessage(text, to))
+        deferred.addBoth(result.append)
+        return result
+
+    @defer.inlineCallbacks
+    def send(self, queue, seconds):
+        """
+        Advance the time and wait for the started SMTP session.
+        """
+        session = queue.waitSession()
+        self.reactor.clock.advance(seconds)
+        yield session
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        """
+        Emails queued together are sent using a single connection, once
+        the batch delay has passed.
+        """
+        factory = FakeSMTPFactory(data_codes=[250, 250, 250])
+        queue = self.getQueue(factory)
+        first = self.add(queue, 'first')
+        self.reactor.clock.advance(0.5)
+        second = self.add(queue, 'second')
+        third = self.add(queue, 'third', to='qa@example.com')
+
+        yield self.send(queue, 1)
+
+        self.assertEqual(1, factory.connections)
+        self.assertEqual(3, len(factory.mails))
+        self.assertEqual(['<qa@example.com>'], factory.mails[2]['to'])
+        self.assertEqual(1, first[0][0])
+        self.assertEqual(1, second[0][0])
+        self.assertEqual(1, third[0][0])
+
+    @defer.inlineCallbacks
+    def test_digest(self):
+        """
+        With `digest`, emails for the same recipients sent together are
+        delivered as a single email.
+        """
+        factory = FakeSMTPFactory(data_codes=[250, 250])
+        queue = self.getQueue(factory, digest=True)
+        self.add(queue, 'first')
+        self.add(queue, 'second')
+        self.add(queue, 'third', to='qa@example.com')
+
+        yield self.send(queue, 1)
+
+        self.assertEqual(2, len(factory.mails))
+        self.assertIn('Subject: 2 build results', factory.mails[0]['data'])
+        self.assertIn('multipart/digest', factory.mails[0]['data'])
+        self.assertIn('Subject: third', factory.mails[1]['data'])
+
+    @defer.inlineCallbacks
+    def test_authentication(self):
+        """
+        Emails are sent after authenticating with the server.
+        """
+        factory = FakeSMTPFactory(
+            data_codes=[250], credentials=('user', 'pass'))
+        queue = self.getQueue(factory, user='user', password='pass')
+        result = self.add(queue, 'first')
+
+        yield self.send(queue, 1)
+
+        self.assertEqual(1, len(factory.mails))
+        self.assertEqual(1, result[0][0])
+
+    @defer.inlineCallbacks
+    def test_authentication_failed(self):
+        """
+        Emails are not retried when the server rejects the credentials.
+        """
+        factory = FakeSMTPFactory(credentials=('user', 'pass'))
+        queue = self.getQueue(factory, user='user', password='bad')
+        first = self.add(queue, 'first')
+        second = self.add(queue, 'second')
+
+        yield self.send(queue, 1)
+
+        self.assertEqual(1, factory.connections)
+        self.assertIsInstance(first[0].value, AUTHDeclinedError)
+        self.assertEqual(535, first[0].value.code)
+        self.assertIsInstance(second[0].value, AUTHDeclinedError)
+        self.assertEqual([], self.reactor.clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_permanent_error(self):
+        """
+        An email rejected with a permanent error is not retried, while
+        the other emails are sent.
+        """
+        factory = FakeSMTPFactory(data_codes=[554, 250])
+        queue = self.getQueue(factory)
+        first = self.add(queue, 'first')
+        second = self.add(queue, 'second')
+
+        yield self.send(queue, 1)
+
+        self.assertEqual(['second'], [
+            mail['data'].split('Subject: ')[1].split('\n')[0]
+            for mail in factory.mails])
+        self.assertIn('554', str(first[0].value))
+        self.assertEqual(1, second[0][0])
+        self.assertEqual([], self.reactor.clock.getDelayedCalls())
+
+    @defer.inlineCallbacks
+    def test_temporary_error(self):
+        """
+        An email rejected with a temporary error is retried after the
+        retry delay, doubled for each retry.
+        """
+        factory = FakeSMTPFactory(data_codes=[451, 451, 250])
+        queue = self.getQueue(factory)
+        result = self.add(queue, 'first')
+
+        yield self.send(queue, 1)
+        self.assertEqual([], result)
+        self.reactor.clock.advance(9)
+        self.assertEqual(1, factory.connections)
+
+        yield self.send(queue, 1)
+        self.assertEqual([], result)
+        self.assertEqual(2, factory.connections)
+
+        yield self.send(queue, 20)
+        self.assertEqual(3, factory.connections)
+        self.assertEqual(1, result[0][0])
+
+    @defer.inlineCallbacks
+    def test_temporary_error_retries(self):
+        """
+        An email is abandoned when still failing after all the retries.
+        """
+        factory = FakeSMTPFactory(data_codes=[451, 451])
+        queue = self.getQueue(factory, retries=1)
+        result = self.add(queue, 'first')
+
+        yield self.send(queue, 1)
+        yield self.send(queue, 10)
+
+        self.assertEqual(2, factory.connections)
+        self.assertIn('451', str(result[0].value))
+
+
+class TestIsPermanentSMTPError(TestCase):
+    """
+    Tests for isPermanentSMTPError.
+    """
+
+    def test_permanent(self):
+        """
+        Errors with 5xx codes or breaking the connection are permanent.
+        """
+        self.assertTrue(isPermanentSMTPError(SMTPClientError(535, 'auth')))
+        self.assertTrue(isPermanentSMTPError(
+            SMTPClientError(-1, 'broken', isFatal=True)))
+
+    def test_temporary(self):
+        """
+        Errors with 4xx codes, errors which can be retried and other
+        errors are temporary.
+        """
+        self.assertFalse(isPermanentSMTPError(SMTPClientError(454, 'auth')))
+        self.assertFalse(isPermanentSMTPError(
+            SMTPClientError(-1, 'timeout', isFatal=True, retry=True)))
+        self.assertFalse(isPermanentSMTPError(Exception('connection lost')))
@@ -0,0 +1,28 @@
+"""
+Tests for formatting notification emails.
+"""
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import time_delta_hr
+
+
+class TestTimeDeltaHR(TestCase):
+    """
+    Tests for time_delta_hr.
+    """
+
+    def test_seconds(self):
+        """
+        Fractions of seconds are ignored.
+        """
+        self.assertEqual('5 seconds', time_delta_hr(100.2, 105.9))
+        self.assertEqual('', time_delta_hr(100, 100.5))
+
+    def test_units(self):
+        """
+        Only the units with a value are included.
+        """
+        self.assertEqual(
+            '1 hours, 2 seconds', time_delta_hr(1000, 1000 + 3602))
+        self.assertEqual(
+            '40 days, 3 minutes', time_delta_hr(0, 40 * 86400 + 180))
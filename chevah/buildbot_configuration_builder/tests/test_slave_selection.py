@@ -0,0 +1,239 @@
+"""
+Tests for choosing the slave of a build.
+"""
+import time
+
+from twisted.trial.unittest import TestCase
+
+from chevah.buildbot_configuration_builder.builder import (
+    WorkspaceAffinitySelector,
+    )
+
+
+class FakeBuildStatus(object):
+    """
+    A finished build.
+    """
+
+    def __init__(self, slavename, finished, got_revision=None):
+        self._slavename = slavename
+        self._finished = finished
+        self._properties = {}
+        if got_revision:
+            self._properties['got_revision'] = got_revision
+
+    def getProperty(self, name, default=None):
+        return self._properties.get(name, default)
+
+    def getSlavename(self):
+        return self._slavename
+
+    def getTimes(self):
+        return (self._finished - 10, self._finished)
+
+
+class FakeBuilderStatus(object):
+    """
+    Status for a builder, with finished builds from oldest to newest.
+    """
+
+    def __init__(self, name, builds):
+        self._name = name
+        self.builds = builds
+        self.current_builds = []
+        self.generated = 0
+
+    @property
+    def nextBuildNumber(self):
+        return len(self.builds) + len(self.current_builds)
+
+    def getName(self):
+        return self._name
+
+    def getCurrentBuilds(self):
+        return self.current_builds
+
+    def generateFinishedBuilds(self, num_builds, max_search, filter_fn):
+        self.generated += 1
+        found = 0
+        for build in reversed(self.builds[-max_search:]):
+            if found == num_builds:
+                return
+            if filter_fn(build):
+                found += 1
+                yield build
+
+
+class FakeBuilder(object):
+    """
+    A Buildbot builder registered in `builders`.
+    """
+
+    def __init__(self, name, builds, builders):
+        self.name = name
+        self.builder_status = FakeBuilderStatus(name, builds)
+        self.master = FakeObject(botmaster=FakeObject(builders=builders))
+        builders[name] = self
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeSlave(object):
+
+    def __init__(self, slavename, free=True):
+        self.slavename = slavename
+        self.free = free
+
+    def canStartBuild(self):
+        return self.free
+
+
+class FakeSlaveBuilder(object):
+
+    def __init__(self, slavename):
+        self.slave = FakeSlave(slavename)
+
+
+class TestWorkspaceAffinitySelector(TestCase):
+    """
+    Tests for WorkspaceAffinitySelector.
+    """
+
+    def setUp(self):
+        self.now = time.time()
+        self.builders = {}
+        self.slaves = [
+            FakeSlaveBuilder('slave-1'),
+            FakeSlaveBuilder('slave-2'),
+            FakeSlaveBuilder('slave-3'),
+            ]
+        self.fallback = self.slaves[0]
+        self.sut = WorkspaceAffinitySelector(
+            selector=lambda builder, slaves: self.fallback,
+            timeout=1000,
+            )
+
+    def addBuilder(self, name, builds):
+        return FakeBuilder(name, builds, self.builders)
+
+    def test_no_builds(self):
+        """
+        The fallback selector is used when no build was finished.
+        """
+        builder = self.addBuilder('linux', [])
+
+        result = self.sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.fallback, result)
+
+    def test_last_checkout(self):
+        """
+        The slave of the last build which checked out the source is used,
+        ignoring builds which failed before the checkout.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-3', self.now - 300, 'abc'),
+            FakeBuildStatus('slave-2', self.now - 200, 'abc'),
+            FakeBuildStatus('slave-1', self.now - 100),
+            ])
+
+        result = self.sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.slaves[1], result)
+
+    def test_started_build(self):
+        """
+        Selecting a slave for a build which is not finished does not
+        change the affinity.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-2', self.now - 200, 'abc'),
+            ])
+        self.sut(builder, self.slaves, ['linux'])
+        builder.builder_status.current_builds.append(object())
+
+        result = self.sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.slaves[1], result)
+
+    def test_finished_build(self):
+        """
+        A new finished build is used, while the previous builds are cached
+        while no build is started or finished.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-2', self.now - 200, 'abc'),
+            ])
+        self.sut(builder, self.slaves, ['linux'])
+        self.sut(builder, self.slaves, ['linux'])
+        self.assertEqual(1, builder.builder_status.generated)
+        builder.builder_status.builds.append(
+            FakeBuildStatus('slave-3', self.now - 100, 'abc'))
+
+        result = self.sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.slaves[2], result)
+        self.assertEqual(2, builder.builder_status.generated)
+
+    def test_multiple_builders(self):
+        """
+        The most recent checkout of all builders sharing the workspace is
+        used, and unknown builders are ignored.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-2', self.now - 200, 'abc'),
+            ])
+        self.addBuilder('windows', [
+            FakeBuildStatus('slave-3', self.now - 100, 'abc'),
+            ])
+
+        result = self.sut(
+            builder, self.slaves, ['linux', 'windows', 'removed'])
+
+        self.assertIs(self.slaves[2], result)
+
+    def test_busy_slave(self):
+        """
+        The fallback selector is used when the slave with the last checkout
+        can not start a build.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-2', self.now - 200, 'abc'),
+            ])
+        self.slaves[1].slave.free = False
+
+        result = self.sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.fallback, result)
+
+    def test_timeout(self):
+        """
+        The fallback selector is used when the last checkout is older than
+        the timeout.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-2', self.now - 2000, 'abc'),
+            ])
+
+        result = self.sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.fallback, result)
+
+    def test_new_selector(self):
+        """
+        The affinity is kept by a new selector, as created on reconfig.
+        """
+        builder = self.addBuilder('linux', [
+            FakeBuildStatus('slave-2', self.now - 200, 'abc'),
+            ])
+        self.sut(builder, self.slaves, ['linux'])
+        sut = WorkspaceAffinitySelector(
+            selector=lambda builder, slaves: self.fallback)
+
+        result = sut(builder, self.slaves, ['linux'])
+
+        self.assertIs(self.slaves[1], result)
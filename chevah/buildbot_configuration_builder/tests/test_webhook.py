@@ -0,0 +1,304 @@
+"""
+Tests for the GitHub webhook change source.
+"""
+import hmac
+import json
+from functools import partial
+from hashlib import sha1
+from StringIO import StringIO
+
+from buildbot.status.web.change_hook import ChangeHookResource
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+from chevah.buildbot_configuration_builder.builder import (
+    ChevahGitHubEventHandler,
+    ChevahGitPoller,
+    ConfigurationBuilder,
+    DEFAULT,
+    normalizeRepository,
+    )
+
+REPO = 'git@github.com:chevah/server.git'
+SECRET = 'webhook-secret'
+
+
+class FakeObject(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeMaster(object):
+    """
+    Buildmaster recording the added changes.
+    """
+
+    def __init__(self, pollers=()):
+        self.changes = []
+        self.change_svc = list(pollers)
+
+    def addChange(self, **kwargs):
+        self.changes.append(kwargs)
+        return defer.succeed(None)
+
+
+def getPushPayload(full_name='chevah/server'):
+    return {
+        'ref': 'refs/heads/master',
+        'after': 'abc123',
+        'repository': {
+            'name': full_name.split('/')[-1],
+            'full_name': full_name,
+            'url': 'https://github.com/%s' % (full_name,),
+            'clone_url': 'https://github.com/%s.git' % (full_name,),
+            },
+        'commits': [{
+            'id': 'abc123',
+            'timestamp': '2017-10-29T10:00:00+00:00',
+            'author': {'name': 'Adi', 'email': 'adi@example.com'},
+            'message': 'Update readme.',
+            'url': 'https://github.com/%s/commit/abc123' % (full_name,),
+            'modified': ['README.rst'],
+            }],
+        }
+
+
+def getPullRequestPayload():
+    return {
+        'action': 'opened',
+        'number': 12,
+        'pull_request': {
+            'commits': 1,
+            'created_at': '2017-10-29T10:00:00+00:00',
+            'head': {'sha': 'def456'},
+            '_links': {'html': {
+                'href': 'https://github.com/chevah/server/pull/12'}},
+            },
+        'repository': {
+            'full_name': 'Chevah/Server',
+            'clone_url': 'https://github.com/chevah/server.git',
+            },
+        'sender': {'login': 'adiroiban'},
+        }
+
+
+class TestNormalizeRepository(TestCase):
+    """
+    Tests for normalizeRepository.
+    """
+
+    def test_slug(self):
+        """
+        Slugs are lower case.
+        """
+        self.assertEqual('chevah/server', normalizeRepository('Chevah/Server'))
+
+    def test_url(self):
+        """
+        The `.git` suffix, the trailing slash and spaces are removed.
+        """
+        self.assertEqual(
+            'https://github.com/chevah/server',
+            normalizeRepository(' https://github.com/Chevah/server.git/ '))
+        self.assertEqual(
+            'git@github.com:chevah/server',
+            normalizeRepository(REPO))
+
+
+class TestGetWebhookRepositories(TestCase):
+    """
+    Tests for ConfigurationBuilder._getWebhookRepositories.
+    """
+
+    def getRepositories(self, projects):
+        builder = ConfigurationBuilder.__new__(ConfigurationBuilder)
+        builder._raw = {'projects': projects}
+        return builder._getWebhookRepositories()
+
+    def test_projects(self):
+        """
+        Projects are found by repository URL and by GitHub slug, and
+        projects sharing a repository are reported together.
+        """
+        result = self.getRepositories({
+            DEFAULT: {'repo': 'ignored'},
+            'server': {'repo': REPO, 'github_slug': 'chevah/server'},
+            'server-docs': {'repo': REPO},
+            'client': {'repo': 'git@github.com:chevah/client.git'},
+            })
+
+        self.assertEqual(
+            (REPO, 'server,server-docs'), result['git@github.com:chevah/server'])
+        self.assertEqual(
+            (REPO, 'server,server-docs'), result['chevah/server'])
+        self.assertEqual(
+            ('git@github.com:chevah/client.git', 'client'),
+            result['git@github.com:chevah/client'])
+        self.assertEqual(3, len(result))
+
+
+class TestChevahGitHubEventHandler(TestCase):
+    """
+    Tests for ChevahGitHubEventHandler, posting payloads to a local
+    change hook.
+    """
+
+    def setUp(self):
+        self.poller = ChevahGitPoller(
+            repourl=REPO, branches=['master', 'production'])
+        self.master = FakeMaster(pollers=[object(), self.poller])
+        self.repositories = {
+            'chevah/server': (REPO, 'server'),
+            normalizeRepository(REPO): (REPO, 'server'),
+            }
+        self.port = self.listen(secret=SECRET, strict=True)
+
+    def listen(self, secret, strict):
+        """
+        Start a web server for the change hook and return its port.
+        """
+        root = Resource()
+        root.putChild('change_hook', ChangeHookResource(dialects={
+            'github': {
+                'class': partial(
+                    ChevahGitHubEventHandler,
+                    repositories=self.repositories,
+                    ),
+                'secret': secret,
+                'strict': strict,
+                },
+            }))
+        site = Site(root)
+        site.buildbot_service = FakeObject(master=self.master)
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port
+
+    @defer.inlineCallbacks
+    def post(self, event, payload, secret=SECRET, port=None):
+        """
+        Post `payload` and return the response code and body.
+        """
+        content = json.dumps(payload)
+        headers = {
+            'Content-Type': ['application/json'],
+            'X-GitHub-Event': [event],
+            }
+        if secret:
+            digest = hmac.new(secret, msg=content, digestmod=sha1)
+            headers['X-Hub-Signature'] = ['sha1=' + digest.hexdigest()]
+
+        port = port or self.port
+        response = yield Agent(reactor).request(
+            'POST',
+            'http://127.0.0.1:%d/change_hook/github' % (
+                port.getHost().port,),
+            Headers(headers),
+            FileBodyProducer(StringIO(content)),
+            )
+        body = yield readBody(response)
+        defer.returnValue((response.code, body))
+
+    @defer.inlineCallbacks
+    def test_push(self):
+        """
+        A signed push for a configured repository creates changes as the
+        ones from the poller, and the poller will not create them again.
+        """
+        code, _ = yield self.post('push', getPushPayload())
+
+        self.assertEqual(202, code)
+        self.assertEqual(1, len(self.master.changes))
+        change = self.master.changes[0]
+        self.assertEqual(REPO, change['repository'])
+        self.assertEqual('server', change['project'])
+        self.assertEqual('server', change['category'])
+        self.assertEqual('master', change['branch'])
+        self.assertEqual('abc123', change['revision'])
+        self.assertEqual(['README.rst'], change['files'])
+        self.assertEqual({'master': 'abc123'}, self.poller.lastRev)
+
+    @defer.inlineCallbacks
+    def test_push_not_polled(self):
+        """
+        The poller revisions are not changed for branches which are not
+        polled.
+        """
+        payload = getPushPayload()
+        payload['ref'] = 'refs/heads/feature'
+
+        code, _ = yield self.post('push', payload)
+
+        self.assertEqual(202, code)
+        self.assertEqual('feature', self.master.changes[0]['branch'])
+        self.assertEqual({}, self.poller.lastRev)
+
+    @defer.inlineCallbacks
+    def test_pull_request(self):
+        """
+        A pull request for a configured repository is matched by slug and
+        keeps the `pull` category.
+        """
+        code, _ = yield self.post('pull_request', getPullRequestPayload())
+
+        self.assertEqual(202, code)
+        change = self.master.changes[0]
+        self.assertEqual(REPO, change['repository'])
+        self.assertEqual('server', change['project'])
+        self.assertEqual('pull', change['category'])
+        self.assertEqual('refs/pull/12/head', change['branch'])
+        self.assertEqual({}, self.poller.lastRev)
+
+    @defer.inlineCallbacks
+    def test_unknown_repository(self):
+        """
+        Payloads for repositories which are not configured are ignored.
+        """
+        code, body = yield self.post(
+            'push', getPushPayload(full_name='other/server'))
+
+        self.assertEqual(200, code)
+        self.assertEqual('no changes found', body)
+        self.assertEqual([], self.master.changes)
+
+    @defer.inlineCallbacks
+    def test_bad_signature(self):
+        """
+        Payloads signed with a different secret are rejected.
+        """
+        code, body = yield self.post(
+            'push', getPushPayload(), secret='other-secret')
+
+        self.assertEqual(400, code)
+        self.assertEqual('Hash mismatch', body)
+        self.assertEqual([], self.master.changes)
+        self.assertEqual({}, self.poller.lastRev)
+
+    @defer.inlineCallbacks
+    def test_no_signature_strict(self):
+        """
+        Payloads without signature are rejected in strict mode.
+        """
+        code, body = yield self.post('push', getPushPayload(), secret=None)
+
+        self.assertEqual(400, code)
+        self.assertEqual('Request has no required signature', body)
+        self.assertEqual([], self.master.changes)
+
+    @defer.inlineCallbacks
+    def test_no_signature(self):
+        """
+        Payloads without signature are accepted when not in strict mode.
+        """
+        port = self.listen(secret=SECRET, strict=False)
+
+        code, _ = yield self.post(
+            'push', getPushPayload(), secret=None, port=port)
+
+        self.assertEqual(202, code)
+        self.assertEqual(1, len(self.master.changes))
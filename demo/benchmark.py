@@ -0,0 +1,380 @@
+#
+# Benchmark configuration generation for large configurations.
+#
+# Configurations are modelled on demo/master.cfg and are scaled by
+# multiplying the number of projects, environments and slaves.
+#
+# Each operation is measured in a separate process so that the peak memory
+# of one operation does not hide the others.
+#
+# Usage:
+#
+#   python demo/benchmark.py [SCALE ...]
+#   python demo/benchmark.py --durations
+#
+import gc
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from chevah.buildbot_configuration_builder.builder import (
+    ConfigurationBuilder,
+    DEFAULT,
+    INTERESTED_USERS,
+    PARALLEL_GROUP,
+    ProjectConfiguration,
+    SEQUENTIAL_GROUP,
+    SLAVE_COMMAND,
+    SOURCE_COMMAND,
+    TRY,
+    time_delta_hr,
+    )
+
+DEFAULT_SCALES = [10, 100, 1000]
+
+# Size of the demo configuration, which is multiplied by the scale.
+DEMO_PROJECTS = 2
+DEMO_ENVIRONMENTS = 5
+DEMO_SLAVES = 6
+
+
+def getConfiguration(scale, htpasswd):
+    """
+    Return a configuration with `scale` times more projects, environments
+    and slaves than the demo configuration.
+    """
+    slave_names = ['slave-%d' % (index,) for index in range(
+        DEMO_SLAVES * scale)]
+    slaves = {
+        DEFAULT: {
+            'password': 'password',
+            'max_builds': 1,
+            },
+        }
+    for name in slave_names:
+        slaves[name] = {}
+
+    environment_names = ['env-%d' % (index,) for index in range(
+        DEMO_ENVIRONMENTS * scale)]
+    environments = {
+        DEFAULT: {
+            'TEST_TYPE': 'normal',
+            },
+        }
+    for index, name in enumerate(environment_names):
+        environments[name] = {
+            'slaves': [
+                slave_names[index % len(slave_names)],
+                slave_names[(index + 1) % len(slave_names)],
+                ],
+            'ENVIRONMENT_INDEX': str(index),
+            }
+
+    steps = {
+        DEFAULT: [
+            {'type': SOURCE_COMMAND},
+            {
+                'name': 'clean',
+                'command': ['make', 'clean'],
+                'optional': True,
+                },
+            {
+                'type': SLAVE_COMMAND,
+                'name': 'test',
+                'command': ['make', 'test'],
+                'timeout': 40,
+                },
+            ],
+        }
+
+    projects = {
+        DEFAULT: {
+            'steps': steps,
+            'poll_interval': 60,
+            },
+        }
+    for index in range(DEMO_PROJECTS * scale):
+        name = 'project-%d' % (index,)
+        # Each project uses a window of environments, like the demo
+        # projects which don't use all the environments.
+        members = [
+            environment_names[(index + offset) % len(environment_names)]
+            for offset in range(DEMO_ENVIRONMENTS - 1)
+            ]
+        projects[name] = {
+            'repo': 'http://git.example.com/%s.git' % (name,),
+            'github_slug': 'example/%s' % (name,),
+            'groups': {
+                'post-commit': members,
+                'supported': members[:2],
+                'urgent': {
+                    'members': members[:1],
+                    'priority': 20,
+                    'fail_fast': True,
+                    },
+                },
+            'gatekeepers': getGatekeepers(environment_names[0]),
+            }
+
+    return {
+        'global': {
+            'title': 'Benchmark',
+            'db_url': 'sqlite://',
+            },
+        'try_scheduler': {
+            'port': 8087,
+            'credentials': [('user', 'pass')],
+            'environment': environment_names[0],
+            },
+        'github': {
+            'token': 'invalid-TOKEN',
+            },
+        'web': {
+            'port': 8080,
+            'htpasswd': htpasswd,
+            },
+        'email': {
+            'server': {
+                'fromaddr': 'buildbot@example.com',
+                'relayhost': 'smtp.example.com',
+                },
+            },
+        'slaves': slaves,
+        'environments': environments,
+        'projects': projects,
+        }
+
+
+def getGatekeepers(environment):
+    """
+    Return gatekeepers similar to the ones from the demo configuration.
+    """
+    return {
+        'post-commit': {
+            'scheduler': 'master',
+            'environment': environment,
+            'steps': [{
+                'type': SEQUENTIAL_GROUP,
+                'name': 'all',
+                'target': 'post-commit',
+                }],
+            'notifications': {
+                'email_all': ['dev@example.com'],
+                },
+            },
+        'review': {
+            'scheduler': TRY,
+            'environment': environment,
+            'steps': [{
+                'type': PARALLEL_GROUP,
+                'name': 'review',
+                'target': 'supported',
+                'max_parallel': 2,
+                }],
+            'notifications': {
+                'email_all': [INTERESTED_USERS],
+                },
+            },
+        'merge': {
+            'scheduler': TRY,
+            'environment': environment,
+            'priority': 10,
+            'steps': [
+                {'type': SOURCE_COMMAND},
+                {
+                    'type': PARALLEL_GROUP,
+                    'name': 'supported',
+                    'target': 'supported',
+                    'fail_fast': True,
+                    },
+                {
+                    'name': 'merge-commit',
+                    'command': ['make', 'merge-branch'],
+                    },
+                ],
+            },
+        }
+
+
+def getWithoutProjects(configuration):
+    """
+    Return a copy of `configuration` with only the default project.
+    """
+    result = configuration.copy()
+    result['projects'] = {DEFAULT: configuration['projects'][DEFAULT]}
+    return result
+
+
+def benchmarkGenerate(configuration):
+    """
+    Generate a new configuration.
+    """
+    return lambda: ConfigurationBuilder(
+        configuration).getBuidbotConfiguration()
+
+
+def benchmarkReconfig(configuration):
+    """
+    Generate the same configuration again, as done on reconfig.
+    """
+    previous = ConfigurationBuilder(configuration)
+    return lambda: ConfigurationBuilder(
+        configuration, previous=previous).getBuidbotConfiguration()
+
+
+def benchmarkResolveEnvironments(configuration):
+    """
+    Resolve all environments.
+    """
+    builder = ConfigurationBuilder(configuration)
+    return builder._resolveEnvironments
+
+
+def benchmarkGetStepEnvironment(configuration):
+    """
+    Get step environment for all environments.
+
+    No project is added, so that the step environments are not already
+    created and interned when measured.
+    """
+    builder = ConfigurationBuilder(getWithoutProjects(configuration))
+
+    def run():
+        builder._step_environments = {}
+        return [
+            builder.getStepEnvironment(name) for name in builder.environments]
+    return run
+
+
+def benchmarkAddProject(configuration):
+    """
+    Add all the projects to a configuration builder.
+    """
+    builder = ConfigurationBuilder(getWithoutProjects(configuration))
+
+    def run():
+        for name, data in configuration['projects'].items():
+            if name == DEFAULT:
+                continue
+            ProjectConfiguration(name, data, builder).addProject()
+    return run
+
+
+BENCHMARKS = [
+    ('generate_configuration', benchmarkGenerate),
+    ('generate_configuration (reconfig)', benchmarkReconfig),
+    ('_resolveEnvironments', benchmarkResolveEnvironments),
+    ('getStepEnvironment', benchmarkGetStepEnvironment),
+    ('addProject', benchmarkAddProject),
+    ]
+
+
+def measure(scale, name):
+    """
+    Return the wall time, peak memory and new objects for benchmark with
+    `name` at `scale`.
+    """
+    htpasswd = tempfile.NamedTemporaryFile()
+    configuration = getConfiguration(scale, htpasswd.name)
+    run = dict(BENCHMARKS)[name](configuration)
+
+    gc.collect()
+    objects_before = len(gc.get_objects())
+    memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+
+    result = run()
+
+    duration = time.time() - start
+    memory_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    objects = len(gc.get_objects()) - objects_before
+
+    data = {
+        'time': duration,
+        # Linux reports the peak memory in kilobytes.
+        'memory': memory_after - memory_before,
+        'objects': objects,
+        }
+    if isinstance(result, dict) and 'builders' in result:
+        data['generated'] = dict(
+            (key, len(result[key]))
+            for key in ['slaves', 'builders', 'schedulers', 'status']
+            )
+    return data
+
+
+def main(scales):
+    """
+    Run all benchmarks for each scale and print the results.
+    """
+    print '%6s %-34s %10s %12s %10s  %s' % (
+        'scale', 'operation', 'time (s)', 'peak (KB)', 'objects', 'generated')
+    for scale in scales:
+        for name, dummy in BENCHMARKS:
+            output = subprocess.check_output([
+                sys.executable, __file__, '--measure', str(scale), name])
+            data = json.loads(output.splitlines()[-1])
+            generated = ', '.join([
+                '%s=%s' % item
+                for item in sorted(data.get('generated', {}).items())
+                ])
+            print '%6d %-34s %10.3f %12d %10d  %s' % (
+                scale, name, data['time'], data['memory'], data['objects'],
+                generated)
+
+
+def dateutil_time_delta_hr(start, end):
+    """
+    The previous time_delta_hr, based on dateutil, used as reference.
+    """
+    import datetime
+    from dateutil.relativedelta import relativedelta
+
+    start_date = datetime.datetime.fromtimestamp(start)
+    end_date = datetime.datetime.fromtimestamp(end)
+    delta = relativedelta(end_date, start_date)
+
+    attributes = ['years', 'months', 'days', 'hours', 'minutes', 'seconds']
+
+    result = []
+    for attribute_name in attributes:
+        attribute = getattr(delta, attribute_name)
+        if attribute > 0:
+            result.append('%d %s' % (attribute, attribute_name))
+
+    return ', '.join(result)
+
+
+def benchmarkDurations(builds=1000, steps=20):
+    """
+    Compare duration formatting for the steps of `builds` builds.
+    """
+    start = time.time()
+    times = [
+        (start + index, start + index + index * 37.5)
+        for index in range(steps)
+        ]
+
+    for name, run in [
+            ('dateutil time_delta_hr', lambda: [
+                dateutil_time_delta_hr(*pair) for pair in times]),
+            ('time_delta_hr', lambda: [
+                time_delta_hr(*pair) for pair in times]),
+            ]:
+        begin = time.time()
+        for dummy in range(builds):
+            run()
+        print '%-24s %10.3f s for %d builds with %d steps' % (
+            name, time.time() - begin, builds, steps)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        print json.dumps(measure(int(sys.argv[2]), sys.argv[3]))
+    elif sys.argv[1:2] == ['--durations']:
+        benchmarkDurations()
+    else:
+        main([int(scale) for scale in sys.argv[1:]] or DEFAULT_SCALES)